@@ -1,20 +1,44 @@
 import os
+from dataclasses import dataclass
 
-# 是否开启debug模式
-DEBUG = True
 
-# 读取数据库环境变量
-username = os.environ.get("MYSQL_USERNAME", 'root')
-password = os.environ.get("MYSQL_PASSWORD", 'root')
-db_address = os.environ.get("MYSQL_ADDRESS", '127.0.0.1:3306')
-db_name = os.environ.get("MYSQL_DATABASE", 'yoyo_meal')
+@dataclass(frozen=True)
+class Settings:
+    """应用配置，启动时从环境变量读取一次，之后只读"""
+    # 是否开启debug模式
+    DEBUG: bool
 
-# 微信小程序配置
-WX_APPID = os.environ.get("WX_APPID", '')
-WX_APP_SECRET = os.environ.get("WX_APP_SECRET", '')
+    # 数据库配置
+    MYSQL_USERNAME: str
+    MYSQL_PASSWORD: str
+    MYSQL_ADDRESS: str
+    MYSQL_DATABASE: str
+    MYSQL_READ_ADDRESS: str  # 只读副本地址，为空时不启用
 
-# JWT配置
-JWT_SECRET = os.environ.get("JWT_SECRET", 'yoyo-meal-secret-key-change-in-production')
+    # Redis配置，为空时使用进程内存储
+    REDIS_URL: str
 
-# 火山引擎AI配置
-VOLCANO_API_KEY = os.environ.get("VOLCANO_API_KEY", '')
+    # 微信小程序配置
+    WX_APPID: str
+    WX_APP_SECRET: str
+
+    # JWT配置
+    JWT_SECRET: str
+
+    # 火山引擎AI配置
+    VOLCANO_API_KEY: str
+
+
+SETTINGS = Settings(
+    DEBUG=True,
+    MYSQL_USERNAME=os.environ.get("MYSQL_USERNAME", 'root'),
+    MYSQL_PASSWORD=os.environ.get("MYSQL_PASSWORD", 'root'),
+    MYSQL_ADDRESS=os.environ.get("MYSQL_ADDRESS", '127.0.0.1:3306'),
+    MYSQL_DATABASE=os.environ.get("MYSQL_DATABASE", 'yoyo_meal'),
+    MYSQL_READ_ADDRESS=os.environ.get("MYSQL_READ_ADDRESS", ''),
+    REDIS_URL=os.environ.get("REDIS_URL", ''),
+    WX_APPID=os.environ.get("WX_APPID", ''),
+    WX_APP_SECRET=os.environ.get("WX_APP_SECRET", ''),
+    JWT_SECRET=os.environ.get("JWT_SECRET", 'yoyo-meal-secret-key-change-in-production'),
+    VOLCANO_API_KEY=os.environ.get("VOLCANO_API_KEY", ''),
+)
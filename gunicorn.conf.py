@@ -0,0 +1,25 @@
+# Gunicorn 配置：容器内生产环境启动（本地开发仍可使用 python3 run.py 0.0.0.0 80）
+#
+# 使用 gthread 线程 worker 而不是 gevent：数据库驱动 mysqlclient 是 C 扩展，
+# gevent 的 monkey patch 无法让其网络 I/O 让出，且应用内部的并行查询、后台任务依赖线程池
+import os
+
+bind = '0.0.0.0:80'
+
+# 容器为1核：2个进程避免单进程GIL争用，每个进程多个线程并发处理以数据库/Redis I/O为主的请求。
+# 每个进程内另有并行查询(6)和后台任务(4)线程池，数据库连接池上限(30)需覆盖三者之和
+worker_class = 'gthread'
+workers = int(os.environ.get('GUNICORN_WORKERS', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+# AI 对话请求需等待大模型返回，放宽超时；keepalive 复用云托管网关到容器的连接
+timeout = 120
+graceful_timeout = 30
+keepalive = 5
+
+# 不使用 preload：线程池、Redis/HTTP 连接池须在各 worker 进程内创建
+preload_app = False
+
+accesslog = None
+errorlog = '-'
+loglevel = 'info'
@@ -0,0 +1,109 @@
+"""
+迁移 001：辅食计划的食材由 meal_plans.food_ids（逗号分隔）改存到 meal_plan_foods 关联表
+
+container.config.json 中的建表语句是 CREATE TABLE IF NOT EXISTS，已有数据库的
+meal_plans 仍保留 food_ids VARCHAR(255) NOT NULL 列，需要运行本脚本迁移。分两步执行，均可重复运行：
+
+    # 1. 部署新代码之前：创建关联表，food_ids 改为可空，回填已有计划的食材
+    python3 migrations/001_meal_plan_foods.py
+
+    # 2. 新代码全部上线之后：再回填一次（补上旧代码在两步之间创建的计划），删除 food_ids 列
+    python3 migrations/001_meal_plan_foods.py --drop
+
+第一步之后新旧代码都能写入：旧代码仍写 food_ids，新代码不写该列也不会违反 NOT NULL。
+回填只处理还没有关联行的计划，食材ID在 Python 中拆分，不限个数。
+"""
+import json
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import inspect, text  # noqa: E402
+
+from wxcloudrun import app, db  # noqa: E402
+from wxcloudrun.model import MealPlanFood  # noqa: E402
+
+logger = logging.getLogger('log')
+
+# 每批回填的计划数
+BATCH_SIZE = 500
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'container.config.json')
+
+
+def _meal_plan_foods_ddl() -> str:
+    """关联表的建表语句，直接取自 container.config.json，保证与新部署的表结构一致"""
+    with open(CONFIG_PATH, encoding='utf-8') as f:
+        sqls = json.load(f)['executeSQLs']
+    return next(sql for sql in sqls if sql.startswith('CREATE TABLE IF NOT EXISTS `meal_plan_foods`'))
+
+
+def _has_food_ids_column(conn) -> bool:
+    return any(column['name'] == 'food_ids' for column in inspect(conn).get_columns('meal_plans'))
+
+
+def _split_food_ids(food_ids: str) -> list:
+    """拆分逗号分隔的食材ID，忽略空项和非数字项"""
+    return [int(item) for item in (part.strip() for part in food_ids.split(',')) if item.isdigit()]
+
+
+def backfill(engine) -> int:
+    """把还没有关联行的计划的 food_ids 写入 meal_plan_foods，按计划ID分批，每批单独提交
+
+    Returns:
+        处理的计划数量
+    """
+    insert_stmt = MealPlanFood.__table__.insert().prefix_with('IGNORE', dialect='mysql')
+    select_stmt = text(
+        "SELECT p.id, p.food_ids FROM meal_plans p "
+        "WHERE p.id > :last_id AND p.food_ids IS NOT NULL AND p.food_ids <> '' "
+        "AND NOT EXISTS (SELECT 1 FROM meal_plan_foods f WHERE f.plan_id = p.id) "
+        "ORDER BY p.id LIMIT :limit"
+    )
+
+    last_id = 0
+    total = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(select_stmt, {'last_id': last_id, 'limit': BATCH_SIZE}).fetchall()
+            if not rows:
+                return total
+            values = [
+                {'plan_id': plan_id, 'position': position, 'food_id': food_id}
+                for plan_id, food_ids in rows
+                for position, food_id in enumerate(_split_food_ids(food_ids))
+            ]
+            if values:
+                conn.execute(insert_stmt, values)
+        total += len(rows)
+        last_id = rows[-1][0]
+
+
+def migrate(drop: bool = False):
+    engine = db.engine
+
+    with engine.begin() as conn:
+        if not inspect(conn).has_table('meal_plan_foods'):
+            conn.execute(text(_meal_plan_foods_ddl()))
+        if not _has_food_ids_column(conn):
+            logger.info("[migration 001] meal_plans.food_ids 已删除，无需迁移")
+            return
+        conn.execute(text(
+            "ALTER TABLE meal_plans MODIFY food_ids VARCHAR(255) NULL DEFAULT NULL "
+            "COMMENT '已迁移到 meal_plan_foods，待删除'"
+        ))
+
+    count = backfill(engine)
+    logger.info(f"[migration 001] 回填了 {count} 个计划的食材")
+
+    if drop:
+        with engine.begin() as conn:
+            conn.execute(text("ALTER TABLE meal_plans DROP COLUMN food_ids"))
+        logger.info("[migration 001] 已删除 meal_plans.food_ids")
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        migrate(drop='--drop' in sys.argv[1:])
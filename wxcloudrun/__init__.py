@@ -1,7 +1,10 @@
-from flask import Flask
+from dataclasses import asdict
+from flask import Flask, Request
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.orm import Session
 import pymysql
-import config
+from config import SETTINGS
 import logging
 import sys
 
@@ -15,27 +18,118 @@ logging.basicConfig(
 logger = logging.getLogger('log')
 logger.setLevel(logging.INFO)
 
-# 因MySQLDB不支持Python3，使用pymysql扩展库代替MySQLDB库
-pymysql.install_as_MySQLdb()
+# 优先使用C扩展的mysqlclient(MySQLdb)驱动；未安装时使用pymysql代替MySQLDB库
+try:
+    import MySQLdb  # noqa: F401
+except ImportError:
+    pymysql.install_as_MySQLdb()
+
+# 请求体JSON解析与响应序列化使用同一个 fastjson（优先 orjson）
+from wxcloudrun.utils import fastjson
+
+
+class FastJSONRequest(Request):
+    json_module = fastjson
+
 
 # 初始化web应用
 app = Flask(__name__, instance_relative_config=True)
-app.config['DEBUG'] = config.DEBUG
+app.request_class = FastJSONRequest
+
+# 加载配置
+app.config.from_mapping(asdict(SETTINGS))
 
 # 设定数据库链接
 app.config['SQLALCHEMY_DATABASE_URI'] = 'mysql://{}:{}@{}/{}'.format(
-    config.username, config.password, config.db_address, config.db_name
+    SETTINGS.MYSQL_USERNAME, SETTINGS.MYSQL_PASSWORD, SETTINGS.MYSQL_ADDRESS, SETTINGS.MYSQL_DATABASE
 )
 
+# 只读副本链接（可选）
+if SETTINGS.MYSQL_READ_ADDRESS:
+    app.config['SQLALCHEMY_BINDS'] = {
+        'read': 'mysql://{}:{}@{}/{}'.format(
+            SETTINGS.MYSQL_USERNAME, SETTINGS.MYSQL_PASSWORD,
+            SETTINGS.MYSQL_READ_ADDRESS, SETTINGS.MYSQL_DATABASE
+        )
+    }
+
+# 连接池配置：复用连接，pre_ping 避免 wait_timeout 后拿到失效连接，
+# 定期回收连接，LIFO 优先复用最近使用的连接
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': 10,
+    'max_overflow': 20,
+    'pool_pre_ping': True,
+    'pool_recycle': 1800,
+    'pool_use_lifo': True,
+}
+
 # 初始化DB操作对象
 db = SQLAlchemy(app)
 
+# 只读副本会话：配置了只读副本时，只读查询通过该会话走副本，请求结束时释放
+read_session = None
+if SETTINGS.MYSQL_READ_ADDRESS:
+    with app.app_context():
+        read_session = db.create_scoped_session(options={
+            'bind': db.get_engine(app, bind='read'),
+            'binds': {}
+        })
+
+    @app.teardown_appcontext
+    def remove_read_session(exc):
+        read_session.remove()
+
+# 每个请求开始时固定当前时间
+from wxcloudrun.utils import clock
+app.before_request(clock.start_request)
+
+
+@event.listens_for(Session, 'after_flush')
+def _mark_flushed(session, flush_context):
+    """记录会话中有已 flush 但未提交的写入（如 commit=False 的写操作或查询前的自动 flush），
+    请求结束时的 commit_session 据此判断是否需要提交"""
+    session.info['flushed'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_rollback')
+def _clear_flushed(session):
+    session.info.pop('flushed', None)
+    session.info.pop('write_failed', None)
+
+
+# 请求结束时统一提交视图中对ORM对象的修改，出错时回滚
+# （自动 flush 后 new/dirty/deleted 已清空，需同时检查 flushed 标记）
+@app.after_request
+def commit_session(response):
+    session = db.session
+    if session.info.get('write_failed') or getattr(response, 'is_error', False) or response.status_code >= 400:
+        # 视图返回错误（包括已处理失败的 commit=False 写操作）时，本次请求未提交的修改一并丢弃
+        session.rollback()
+        return response
+    if session.new or session.dirty or session.deleted or session.info.get('flushed'):
+        try:
+            session.commit()
+        except Exception as e:
+            logger.error(f"commit_session error: {e}")
+            session.rollback()
+            from wxcloudrun.response import make_err_response
+            return make_err_response('保存失败，请稍后重试', error_code='COMMIT_FAILED')
+    return response
+
+
+@app.teardown_request
+def rollback_session(exc):
+    if exc is not None:
+        db.session.rollback()
+
 # 加载控制器
 from wxcloudrun import views
 
-# 加载配置
-app.config.from_object('config')
 
-# 创建数据库表（如果不存在）
-with app.app_context():
+# 创建数据库表（如果不存在）。表结构由部署时的建表SQL维护，
+# 本地开发首次运行执行一次即可：FLASK_APP=wxcloudrun flask init-db
+@app.cli.command('init-db')
+def init_db():
+    """创建数据库表"""
     db.create_all()
@@ -1,20 +1,127 @@
 import logging
-from datetime import datetime, date, timedelta
-from typing import Optional, List
-
+import threading
+import time
+from contextlib import contextmanager
+from itertools import chain
+from datetime import date, timedelta
+from typing import Dict, Optional, List, Set, Tuple
+
+from flask import g, has_app_context
 from sqlalchemy.exc import OperationalError, SQLAlchemyError
-from sqlalchemy import and_, or_
+from sqlalchemy import and_, or_, case, event, func, insert, update
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.orm import Session, selectinload
 
-from wxcloudrun import db
+from wxcloudrun import db, read_session
+from wxcloudrun.utils import clock, redis_client
 from wxcloudrun.model import (
     User, Baby, BabyManager, Food, BabyFoodStatus,
-    MealPlan, SpecialStatus, Invitation
+    MealPlan, MealPlanFood, SpecialStatus, Invitation
 )
 
 # 初始化日志
 logger = logging.getLogger('log')
 
 
+# ==========================================
+# 事务
+# ==========================================
+
+class TransactionFailed(Exception):
+    """外层事务中（commit=False）的写操作失败，整个事务需回滚"""
+
+
+@contextmanager
+def transaction():
+    """将多次写操作合并到一个事务中，正常退出时统一提交，异常时回滚
+
+    块内调用写操作需传 commit=False，例如：
+        with dao.transaction():
+            baby = dao.create_baby(..., commit=False)
+            user.current_baby_id = baby.id
+
+    块内写操作失败时抛出 TransactionFailed（事务已整体回滚），调用方捕获后返回错误
+    """
+    try:
+        yield db.session
+        db.session.commit()
+    except TransactionFailed:
+        db.session.rollback()
+        raise
+    except SQLAlchemyError as e:
+        # 块内直接修改ORM对象时，flush/提交阶段的数据库错误同样按事务失败处理
+        logger.error(f"transaction error: {e}")
+        db.session.rollback()
+        raise TransactionFailed(str(e)) from e
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def _commit(commit: bool):
+    """提交事务；在外层事务中只flush（写入SQL并拿到自增ID，由外层统一提交）"""
+    if commit:
+        db.session.commit()
+    else:
+        db.session.flush()
+
+
+def _handle_write_error(commit: bool, e: Exception):
+    """写操作失败时在 except 块中调用
+
+    单独提交的写操作直接回滚；在外层事务中不在此回滚（否则会连同外层已执行的写操作
+    一起回滚，而调用方并不知情），抛出 TransactionFailed 由 transaction() 回滚整个事务
+    """
+    if not commit:
+        # 标记本次请求的写入不可提交，请求结束时 commit_session 改为回滚
+        db.session.info['write_failed'] = True
+        raise TransactionFailed(str(e)) from e
+    db.session.rollback()
+
+
+# ==========================================
+# 宝宝数据变更跟踪
+# 事务提交后递增涉及宝宝的数据版本号（见 redis_client），使相关缓存失效
+# ==========================================
+
+def mark_baby_changed(baby_id: int):
+    """记录当前事务修改了该宝宝的数据（用于ORM之外的批量语句）"""
+    db.session.info.setdefault('changed_babies', set()).add(baby_id)
+
+
+@event.listens_for(Session, 'before_flush')
+def _collect_changed_babies(session, flush_context, instances):
+    """flush 时收集被修改对象所属的宝宝"""
+    changed = session.info.setdefault('changed_babies', set())
+    for obj in chain(session.new, session.dirty, session.deleted):
+        baby_id = obj.id if isinstance(obj, Baby) else getattr(obj, 'baby_id', None)
+        if baby_id:
+            changed.add(baby_id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _bump_changed_babies(session):
+    baby_ids = session.info.pop('changed_babies', None)
+    if baby_ids:
+        redis_client.bump_baby_versions(baby_ids)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_changed_babies(session):
+    session.info.pop('changed_babies', None)
+
+
+def _read_query(*entities):
+    """只读查询；配置了只读副本时走副本会话（数据可能有少量复制延迟）
+
+    只用于可容忍延迟的数据（食材库）。宝宝相关数据的读取结果会被缓存或据此写入，
+    须走主库，否则可能读到提交前的旧数据
+    """
+    if read_session is not None:
+        return read_session.query(*entities)
+    return db.session.query(*entities)
+
+
 # ==========================================
 # 用户相关 DAO
 # ==========================================
@@ -42,14 +149,14 @@ def get_user_by_token(token: str) -> Optional[User]:
     try:
         return User.query.filter(
             User.token == token,
-            User.token_expires_at > datetime.now()
+            User.token_expires_at > clock.now()
         ).first()
     except OperationalError as e:
         logger.error(f"get_user_by_token error: {e}")
         return None
 
 
-def create_user(openid: str, nickname: str = None, avatar_url: str = None) -> Optional[User]:
+def create_user(openid: str, nickname: str = None, avatar_url: str = None, commit: bool = True) -> Optional[User]:
     """创建用户"""
     try:
         user = User(
@@ -58,25 +165,14 @@ def create_user(openid: str, nickname: str = None, avatar_url: str = None) -> Op
             avatar_url=avatar_url
         )
         db.session.add(user)
-        db.session.commit()
+        _commit(commit)
         return user
     except SQLAlchemyError as e:
         logger.error(f"create_user error: {e}")
-        db.session.rollback()
+        _handle_write_error(commit, e)
         return None
 
 
-def update_user(user: User) -> bool:
-    """更新用户"""
-    try:
-        db.session.commit()
-        return True
-    except OperationalError as e:
-        logger.error(f"update_user error: {e}")
-        db.session.rollback()
-        return False
-
-
 # ==========================================
 # 宝宝相关 DAO
 # ==========================================
@@ -93,16 +189,12 @@ def get_baby_by_id(baby_id: int) -> Optional[Baby]:
 def get_babies_by_user(user_id: int) -> List[Baby]:
     """获取用户管理的所有宝宝"""
     try:
-        # 通过baby_managers表关联查询
-        baby_ids = db.session.query(BabyManager.baby_id).filter(
+        # 通过baby_managers表JOIN，一次查询完成
+        return Baby.query.join(
+            BabyManager, BabyManager.baby_id == Baby.id
+        ).filter(
             BabyManager.user_id == user_id
         ).all()
-        baby_ids = [bid[0] for bid in baby_ids]
-
-        if not baby_ids:
-            return []
-
-        return Baby.query.filter(Baby.id.in_(baby_ids)).all()
     except OperationalError as e:
         logger.error(f"get_babies_by_user error: {e}")
         return []
@@ -110,7 +202,7 @@ def get_babies_by_user(user_id: int) -> List[Baby]:
 
 def create_baby(name: str, birthday: date, gender: int, created_by: int,
                 avatar: str = None, allergy_notes: str = None,
-                food_preferences: str = None) -> Optional[Baby]:
+                food_preferences: str = None, commit: bool = True) -> Optional[Baby]:
     """创建宝宝"""
     try:
         baby = Baby(
@@ -122,56 +214,50 @@ def create_baby(name: str, birthday: date, gender: int, created_by: int,
             allergy_notes=allergy_notes,
             food_preferences=food_preferences
         )
-        db.session.add(baby)
-        db.session.flush()  # 获取baby.id
-
-        # 同时创建管理员关系
-        manager = BabyManager(
-            baby_id=baby.id,
+        # 同时创建管理员关系，随宝宝在同一次flush中写入
+        baby.managers.append(BabyManager(
             user_id=created_by,
             role='owner'
-        )
-        db.session.add(manager)
-        db.session.commit()
+        ))
+        db.session.add(baby)
+        _commit(commit)
         return baby
     except OperationalError as e:
         logger.error(f"create_baby error: {e}")
-        db.session.rollback()
+        _handle_write_error(commit, e)
         return None
 
 
-def update_baby(baby: Baby) -> bool:
-    """更新宝宝信息"""
-    try:
-        db.session.commit()
-        return True
-    except OperationalError as e:
-        logger.error(f"update_baby error: {e}")
-        db.session.rollback()
-        return False
-
+def delete_baby(baby_id: int, commit: bool = True) -> bool:
+    """删除宝宝及相关数据
 
-def delete_baby(baby_id: int) -> bool:
-    """删除宝宝及相关数据"""
+    所有删除在同一事务中执行，使用 synchronize_session=False 直接下发
+    DELETE，跳过对会话 identity map 的逐行扫描
+    """
     try:
+        mark_baby_changed(baby_id)
+
         # 删除相关的管理员关系
-        BabyManager.query.filter(BabyManager.baby_id == baby_id).delete()
+        BabyManager.query.filter(BabyManager.baby_id == baby_id).delete(synchronize_session=False)
         # 删除相关的食材状态
-        BabyFoodStatus.query.filter(BabyFoodStatus.baby_id == baby_id).delete()
-        # 删除相关的辅食计划
-        MealPlan.query.filter(MealPlan.baby_id == baby_id).delete()
+        BabyFoodStatus.query.filter(BabyFoodStatus.baby_id == baby_id).delete(synchronize_session=False)
+        # 删除相关的辅食计划及其食材
+        MealPlanFood.query.filter(MealPlanFood.plan_id.in_(
+            db.session.query(MealPlan.id).filter(MealPlan.baby_id == baby_id)
+        )).delete(synchronize_session=False)
+        MealPlan.query.filter(MealPlan.baby_id == baby_id).delete(synchronize_session=False)
         # 删除相关的特殊状态
-        SpecialStatus.query.filter(SpecialStatus.baby_id == baby_id).delete()
+        SpecialStatus.query.filter(SpecialStatus.baby_id == baby_id).delete(synchronize_session=False)
         # 删除相关的邀请
-        Invitation.query.filter(Invitation.baby_id == baby_id).delete()
+        Invitation.query.filter(Invitation.baby_id == baby_id).delete(synchronize_session=False)
         # 删除宝宝
-        Baby.query.filter(Baby.id == baby_id).delete()
+        Baby.query.filter(Baby.id == baby_id).delete(synchronize_session=False)
 
-        db.session.commit()
+        _commit(commit)
         return True
     except OperationalError as e:
         logger.error(f"delete_baby error: {e}")
-        db.session.rollback()
+        _handle_write_error(commit, e)
         return False
 
 
@@ -200,7 +286,42 @@ def get_baby_managers(baby_id: int) -> List[BabyManager]:
         return []
 
 
-def add_baby_manager(baby_id: int, user_id: int, invited_by: int) -> Optional[BabyManager]:
+def get_baby_managers_with_users(baby_id: int) -> List[tuple]:
+    """获取宝宝的所有管理员及其用户昵称、头像（一次JOIN查询）
+
+    Returns:
+        [(user_id, role, created_at, nickname, avatar_url), ...]，用户不存在时昵称和头像为 None
+    """
+    try:
+        return db.session.query(
+            BabyManager.user_id, BabyManager.role, BabyManager.created_at,
+            User.nickname, User.avatar_url
+        ).outerjoin(
+            User, User.id == BabyManager.user_id
+        ).filter(
+            BabyManager.baby_id == baby_id
+        ).all()
+    except OperationalError as e:
+        logger.error(f"get_baby_managers_with_users error: {e}")
+        return []
+
+
+def get_baby_managers_for_user(user_id: int, baby_ids: List[int]) -> Dict[int, BabyManager]:
+    """批量获取用户对多个宝宝的管理员关系，返回 {baby_id: BabyManager}"""
+    if not baby_ids:
+        return {}
+    try:
+        managers = BabyManager.query.filter(
+            BabyManager.user_id == user_id,
+            BabyManager.baby_id.in_(baby_ids)
+        ).all()
+        return {manager.baby_id: manager for manager in managers}
+    except OperationalError as e:
+        logger.error(f"get_baby_managers_for_user error: {e}")
+        return {}
+
+
+def add_baby_manager(baby_id: int, user_id: int, invited_by: int, commit: bool = True) -> Optional[BabyManager]:
     """添加宝宝管理员"""
     try:
         manager = BabyManager(
@@ -210,26 +331,26 @@ def add_baby_manager(baby_id: int, user_id: int, invited_by: int) -> Optional[Ba
             invited_by=invited_by
         )
         db.session.add(manager)
-        db.session.commit()
+        _commit(commit)
         return manager
     except OperationalError as e:
         logger.error(f"add_baby_manager error: {e}")
-        db.session.rollback()
+        _handle_write_error(commit, e)
         return None
 
 
-def remove_baby_manager(baby_id: int, user_id: int) -> bool:
+def remove_baby_manager(baby_id: int, user_id: int, commit: bool = True) -> bool:
     """移除宝宝管理员"""
     try:
         BabyManager.query.filter(
             BabyManager.baby_id == baby_id,
             BabyManager.user_id == user_id
         ).delete()
-        db.session.commit()
+        _commit(commit)
         return True
     except OperationalError as e:
         logger.error(f"remove_baby_manager error: {e}")
-        db.session.rollback()
+        _handle_write_error(commit, e)
         return False
 
 
@@ -237,41 +358,108 @@ def remove_baby_manager(baby_id: int, user_id: int) -> bool:
 # 食材相关 DAO
 # ==========================================
 
-def get_all_foods(category: str = None, max_month: int = None) -> List[Food]:
-    """获取食材列表"""
-    try:
-        query = Food.query.filter(Food.is_active == True)
+# 食材表属于基础数据，极少变动，整表缓存在进程内，定期重新加载
+# （应用内没有修改食材表的接口，直接改表后最多 FOOD_CACHE_TTL 秒生效）
+FOOD_CACHE_TTL = 300  # 秒
+
+_food_cache_lock = threading.Lock()
+# 每次重新加载都生成新的字典并整体替换，已取得的旧快照保持不变
+_food_cache = {
+    'expires_at': 0.0,
+    'by_id': {},        # {food_id: Food}，包含已下架食材
+    'by_name': {},      # {name: Food}，仅上架食材
+    'lists': {},        # {(category, max_month): [Food]}
+}
+
+
+def _load_food_cache() -> Optional[dict]:
+    """获取食材缓存，过期时整表重新加载"""
+    global _food_cache
+    cache = _food_cache
+    if cache['expires_at'] > time.monotonic():
+        return cache
+
+    with _food_cache_lock:
+        cache = _food_cache
+        if cache['expires_at'] > time.monotonic():
+            return cache
+        try:
+            query = _read_query(Food)
+            foods = query.order_by(Food.sort_order).all()
+        except OperationalError as e:
+            logger.error(f"_load_food_cache error: {e}")
+            return None
+
+        # 脱离会话，避免提交后被expire导致跨请求访问失败
+        for food in foods:
+            query.session.expunge(food)
+
+        by_name = {}
+        for food in foods:
+            if food.is_active:
+                by_name.setdefault(food.name, food)
+        _food_cache = {
+            'expires_at': time.monotonic() + FOOD_CACHE_TTL,
+            'by_id': {food.id: food for food in foods},
+            'by_name': by_name,
+            'lists': {},
+        }
+        return _food_cache
+
+
+def _food_catalog() -> Optional[dict]:
+    """获取本次请求使用的食材快照
+
+    请求内首次访问时从进程缓存取得并记录在g上，之后直接复用，
+    既省去每次的过期检查，也保证同一请求内看到的食材数据一致
+    """
+    if not has_app_context():
+        return _load_food_cache()
 
-        if category:
-            query = query.filter(Food.category == category)
+    catalog = g.get('food_catalog')
+    if catalog is None:
+        catalog = _load_food_cache()
+        if catalog is not None:
+            g.food_catalog = catalog
+    return catalog
 
-        if max_month is not None:
-            query = query.filter(Food.min_month <= max_month)
 
-        return query.order_by(Food.sort_order).all()
-    except OperationalError as e:
-        logger.error(f"get_all_foods error: {e}")
+def get_all_foods(category: str = None, max_month: int = None) -> List[Food]:
+    """获取食材列表"""
+    cache = _food_catalog()
+    if cache is None:
         return []
 
+    key = (category, max_month)
+    foods = cache['lists'].get(key)
+    if foods is None:
+        foods = [
+            food for food in cache['by_id'].values()
+            if food.is_active
+            and (not category or food.category == category)
+            and (max_month is None or food.min_month <= max_month)
+        ]
+        cache['lists'][key] = foods
+    return list(foods)
+
 
 def get_food_by_id(food_id: int) -> Optional[Food]:
     """根据ID获取食材"""
-    try:
-        return Food.query.get(food_id)
-    except OperationalError as e:
-        logger.error(f"get_food_by_id error: {e}")
+    cache = _food_catalog()
+    if cache is None:
         return None
+    return cache['by_id'].get(food_id)
 
 
 def get_foods_by_ids(food_ids: List[int]) -> List[Food]:
     """根据ID列表获取食材"""
-    try:
-        if not food_ids:
-            return []
-        return Food.query.filter(Food.id.in_(food_ids)).all()
-    except OperationalError as e:
-        logger.error(f"get_foods_by_ids error: {e}")
+    if not food_ids:
+        return []
+    cache = _food_catalog()
+    if cache is None:
         return []
+    by_id = cache['by_id']
+    return [by_id[fid] for fid in dict.fromkeys(food_ids) if fid in by_id]
 
 
 # ==========================================
@@ -290,24 +478,55 @@ def get_baby_food_status(baby_id: int, food_id: int) -> Optional[BabyFoodStatus]
         return None
 
 
-def get_baby_food_statuses(baby_id: int, status: str = None) -> List[BabyFoodStatus]:
-    """获取宝宝的食材状态列表"""
+def get_baby_food_statuses(
+    baby_id: int,
+    status: str = None,
+    limit: Optional[int] = None
+) -> List[BabyFoodStatus]:
+    """获取宝宝的食材状态列表；指定 limit 时按更新时间倒序只取最近的若干条"""
     try:
         query = BabyFoodStatus.query.filter(BabyFoodStatus.baby_id == baby_id)
 
         if status:
             query = query.filter(BabyFoodStatus.status == status)
 
+        if limit is not None:
+            query = query.order_by(BabyFoodStatus.updated_at.desc()).limit(limit)
+
         return query.all()
     except OperationalError as e:
         logger.error(f"get_baby_food_statuses error: {e}")
         return []
 
 
+def get_baby_food_status_map(baby_id: int) -> Dict[int, str]:
+    """获取宝宝所有食材的状态，返回 {food_id: status}（只查询两列）"""
+    try:
+        rows = db.session.query(BabyFoodStatus.food_id, BabyFoodStatus.status).filter(
+            BabyFoodStatus.baby_id == baby_id
+        ).all()
+        return dict(rows)
+    except OperationalError as e:
+        logger.error(f"get_baby_food_status_map error: {e}")
+        return {}
+
+
+def count_baby_food_statuses(baby_id: int) -> Dict[str, int]:
+    """按状态统计宝宝的食材数量，如 {'safe': 12, 'allergic': 1}"""
+    try:
+        rows = db.session.query(BabyFoodStatus.status, func.count()).filter(
+            BabyFoodStatus.baby_id == baby_id
+        ).group_by(BabyFoodStatus.status).all()
+        return dict(rows)
+    except OperationalError as e:
+        logger.error(f"count_baby_food_statuses error: {e}")
+        return {}
+
+
 def get_baby_testing_food(baby_id: int) -> Optional[BabyFoodStatus]:
     """获取宝宝正在排敏的食材"""
     try:
-        today = date.today()
+        today = clock.today()
         return BabyFoodStatus.query.filter(
             BabyFoodStatus.baby_id == baby_id,
             BabyFoodStatus.status == 'testing',
@@ -326,53 +545,111 @@ def create_or_update_baby_food_status(
     testing_start_date: date = None,
     testing_end_date: date = None,
     allergy_symptoms: str = None,
-    notes: str = None
+    notes: str = None,
+    commit: bool = True
 ) -> Optional[BabyFoodStatus]:
-    """创建或更新宝宝食材状态"""
-    try:
-        food_status = get_baby_food_status(baby_id, food_id)
-
-        if food_status:
-            food_status.status = status
-            food_status.updated_by = updated_by
-            if testing_start_date:
-                food_status.testing_start_date = testing_start_date
-            if testing_end_date:
-                food_status.testing_end_date = testing_end_date
-            if allergy_symptoms:
-                food_status.allergy_symptoms = allergy_symptoms
-            if notes:
-                food_status.notes = notes
-            if status == 'allergic':
-                food_status.allergy_count += 1
-        else:
-            food_status = BabyFoodStatus(
-                baby_id=baby_id,
-                food_id=food_id,
-                status=status,
-                updated_by=updated_by,
-                testing_start_date=testing_start_date,
-                testing_end_date=testing_end_date,
-                allergy_symptoms=allergy_symptoms,
-                notes=notes
-            )
-            db.session.add(food_status)
+    """创建或更新宝宝食材状态
 
-        db.session.commit()
-        return food_status
+    使用 INSERT ... ON DUPLICATE KEY UPDATE（依赖 uk_baby_food 唯一键）一条语句完成，
+    未传的可选字段保留原值，状态为过敏时累加过敏次数
+    """
+    try:
+        now = clock.now()
+        stmt = mysql_insert(BabyFoodStatus.__table__).values(
+            baby_id=baby_id,
+            food_id=food_id,
+            status=status,
+            updated_by=updated_by,
+            testing_start_date=testing_start_date,
+            testing_end_date=testing_end_date,
+            allergy_symptoms=allergy_symptoms or None,
+            notes=notes or None,
+            allergy_count=0,
+            created_at=now,
+            updated_at=now
+        )
+        inserted = stmt.inserted
+        table = BabyFoodStatus.__table__.c
+        stmt = stmt.on_duplicate_key_update(
+            allergy_count=table.allergy_count + case((inserted.status == 'allergic', 1), else_=0),
+            status=inserted.status,
+            updated_by=inserted.updated_by,
+            testing_start_date=func.coalesce(inserted.testing_start_date, table.testing_start_date),
+            testing_end_date=func.coalesce(inserted.testing_end_date, table.testing_end_date),
+            allergy_symptoms=func.coalesce(inserted.allergy_symptoms, table.allergy_symptoms),
+            notes=func.coalesce(inserted.notes, table.notes),
+            updated_at=inserted.updated_at
+        )
+        db.session.execute(stmt)
+        mark_baby_changed(baby_id)
+        _commit(commit)
+        return get_baby_food_status(baby_id, food_id)
     except OperationalError as e:
         logger.error(f"create_or_update_baby_food_status error: {e}")
-        db.session.rollback()
+        _handle_write_error(commit, e)
         return None
 
 
-def start_food_testing(baby_id: int, food_id: int, updated_by: int, days: int = 3) -> Optional[BabyFoodStatus]:
+def bulk_upsert_baby_food_statuses(baby_id: int, updated_by: int, items: List[dict],
+                                   commit: bool = True) -> int:
+    """批量创建或更新宝宝食材状态
+
+    与 create_or_update_baby_food_status 规则相同，所有食材合并为一条
+    INSERT ... ON DUPLICATE KEY UPDATE 多行语句
+
+    Args:
+        items: 已校验的状态列表，每个元素包含 food_id, status，可选 notes
+
+    Returns:
+        写入的食材数量，失败返回0
+    """
+    if not items:
+        return 0
+
+    try:
+        now = clock.now()
+        # 同一食材出现多次时以最后一条为准
+        rows = {
+            item['food_id']: {
+                'baby_id': baby_id,
+                'food_id': item['food_id'],
+                'status': item['status'],
+                'updated_by': updated_by,
+                'notes': item.get('notes') or None,
+                'allergy_count': 0,
+                'created_at': now,
+                'updated_at': now
+            }
+            for item in items
+        }
+        stmt = mysql_insert(BabyFoodStatus.__table__).values(list(rows.values()))
+        inserted = stmt.inserted
+        table = BabyFoodStatus.__table__.c
+        stmt = stmt.on_duplicate_key_update(
+            allergy_count=table.allergy_count + case((inserted.status == 'allergic', 1), else_=0),
+            status=inserted.status,
+            updated_by=inserted.updated_by,
+            notes=func.coalesce(inserted.notes, table.notes),
+            updated_at=inserted.updated_at
+        )
+        db.session.execute(stmt)
+        mark_baby_changed(baby_id)
+        _commit(commit)
+        return len(rows)
+    except SQLAlchemyError as e:
+        logger.error(f"bulk_upsert_baby_food_statuses error: {e}")
+        _handle_write_error(commit, e)
+        return 0
+
+
+def start_food_testing(baby_id: int, food_id: int, updated_by: int, days: int = 3,
+                       commit: bool = True) -> Optional[BabyFoodStatus]:
     """开始食材排敏
 
     排敏期从今天开始，持续 days 天（包含今天）
     例如：days=3, 今天1月5日，则排敏期为1月5日-1月7日
     """
-    today = date.today()
+    today = clock.today()
     end_date = today + timedelta(days=days - 1)  # 包含今天，所以减1
 
     return create_or_update_baby_food_status(
@@ -381,7 +658,8 @@ def start_food_testing(baby_id: int, food_id: int, updated_by: int, days: int =
         status='testing',
         updated_by=updated_by,
         testing_start_date=today,
-        testing_end_date=end_date
+        testing_end_date=end_date,
+        commit=commit
     )
 
 
@@ -390,9 +668,11 @@ def start_food_testing(baby_id: int, food_id: int, updated_by: int, days: int =
 # ==========================================
 
 def get_meal_plans_by_date(baby_id: int, plan_date: date) -> List[MealPlan]:
-    """获取某天的辅食计划"""
+    """获取某天的辅食计划（同时批量加载宝宝对新食材的状态）"""
     try:
-        return MealPlan.query.filter(
+        return MealPlan.query.options(
+            selectinload(MealPlan.new_food_status)
+        ).filter(
             MealPlan.baby_id == baby_id,
             MealPlan.plan_date == plan_date
         ).order_by(MealPlan.meal_type).all()
@@ -402,9 +682,12 @@ def get_meal_plans_by_date(baby_id: int, plan_date: date) -> List[MealPlan]:
 
 
 def get_meal_plans_by_date_range(baby_id: int, start_date: date, end_date: date) -> List[MealPlan]:
-    """获取日期范围内的辅食计划"""
+    """获取日期范围内的辅食计划（同时批量加载计划中的食材和新食材）"""
     try:
-        return MealPlan.query.filter(
+        return MealPlan.query.options(
+            selectinload(MealPlan.foods).joinedload(MealPlanFood.food),
+            selectinload(MealPlan.new_food)
+        ).filter(
             MealPlan.baby_id == baby_id,
             MealPlan.plan_date >= start_date,
             MealPlan.plan_date <= end_date
@@ -435,7 +718,8 @@ def create_or_update_meal_plan(
     created_by: int,
     new_food_id: int = None,
     is_ai_generated: bool = False,
-    notes: str = None
+    notes: str = None,
+    commit: bool = True
 ) -> Optional[MealPlan]:
     """创建或更新辅食计划"""
     try:
@@ -451,47 +735,61 @@ def create_or_update_meal_plan(
                 baby_id=baby_id,
                 plan_date=plan_date,
                 meal_type=meal_type,
-                food_ids=','.join(str(fid) for fid in food_ids),
                 new_food_id=new_food_id,
                 is_ai_generated=is_ai_generated,
                 notes=notes,
                 created_by=created_by
             )
+            plan.set_food_id_list(food_ids)
             db.session.add(plan)
 
-        db.session.commit()
+        _commit(commit)
         return plan
     except OperationalError as e:
         logger.error(f"create_or_update_meal_plan error: {e}")
-        db.session.rollback()
+        _handle_write_error(commit, e)
         return None
 
 
-def complete_meal_plan(plan_id: int) -> bool:
-    """标记辅食计划完成"""
+def complete_meal_plan(baby_id: int, plan_id: int, commit: bool = True) -> bool:
+    """标记辅食计划完成
+
+    一条 UPDATE 完成（不先查询计划），只更新属于该宝宝的计划；计划不存在时返回 False
+    """
     try:
-        plan = MealPlan.query.get(plan_id)
-        if plan:
-            plan.is_completed = True
-            plan.completed_at = datetime.now()
-            db.session.commit()
-            return True
-        return False
+        updated = MealPlan.query.filter(
+            MealPlan.id == plan_id,
+            MealPlan.baby_id == baby_id
+        ).update({
+            'is_completed': True,
+            'completed_at': clock.now()
+        }, synchronize_session=False)
+        if not updated:
+            return False
+        mark_baby_changed(baby_id)
+        _commit(commit)
+        return True
     except OperationalError as e:
         logger.error(f"complete_meal_plan error: {e}")
-        db.session.rollback()
+        _handle_write_error(commit, e)
         return False
 
 
-def delete_meal_plan(plan_id: int) -> bool:
-    """删除辅食计划"""
+def delete_meal_plan(baby_id: int, plan_id: int, commit: bool = True) -> bool:
+    """删除辅食计划（只删除属于该宝宝的计划，计划不存在时视为已删除）"""
     try:
-        MealPlan.query.filter(MealPlan.id == plan_id).delete()
-        db.session.commit()
+        deleted = MealPlan.query.filter(
+            MealPlan.id == plan_id,
+            MealPlan.baby_id == baby_id
+        ).delete(synchronize_session=False)
+        if deleted:
+            mark_baby_changed(baby_id)
+            MealPlanFood.query.filter(MealPlanFood.plan_id == plan_id).delete(synchronize_session=False)
+            _commit(commit)
         return True
     except OperationalError as e:
         logger.error(f"delete_meal_plan error: {e}")
-        db.session.rollback()
+        _handle_write_error(commit, e)
         return False
 
 
@@ -502,7 +800,7 @@ def delete_meal_plan(plan_id: int) -> bool:
 def get_active_special_status(baby_id: int) -> Optional[SpecialStatus]:
     """获取宝宝当前有效的特殊状态"""
     try:
-        today = date.today()
+        today = clock.today()
         return SpecialStatus.query.filter(
             SpecialStatus.baby_id == baby_id,
             SpecialStatus.is_active == True,
@@ -513,12 +811,55 @@ def get_active_special_status(baby_id: int) -> Optional[SpecialStatus]:
         return None
 
 
+def get_baby_ids_with_active_special_status(baby_ids: List[int]) -> Set[int]:
+    """批量判断多个宝宝是否有当前有效的特殊状态，返回有特殊状态的宝宝ID集合（只查询 baby_id 列）"""
+    if not baby_ids:
+        return set()
+    try:
+        today = clock.today()
+        rows = db.session.query(SpecialStatus.baby_id).filter(
+            SpecialStatus.baby_id.in_(baby_ids),
+            SpecialStatus.is_active == True,
+            SpecialStatus.end_date >= today
+        ).distinct().all()
+        return {row.baby_id for row in rows}
+    except OperationalError as e:
+        logger.error(f"get_baby_ids_with_active_special_status error: {e}")
+        return set()
+
+
+def get_new_food_blockers(baby_id: int) -> Tuple[bool, Optional[int]]:
+    """一条查询判断宝宝当前能否添加新食材
+
+    Returns:
+        (是否有有效的特殊状态, 正在排敏的食材ID或None)
+    """
+    try:
+        today = clock.today()
+        has_special_status = db.session.query(SpecialStatus.id).filter(
+            SpecialStatus.baby_id == baby_id,
+            SpecialStatus.is_active == True,
+            SpecialStatus.end_date >= today
+        ).exists()
+        testing_food_id = db.session.query(BabyFoodStatus.food_id).filter(
+            BabyFoodStatus.baby_id == baby_id,
+            BabyFoodStatus.status == 'testing',
+            BabyFoodStatus.testing_end_date >= today
+        ).limit(1).scalar_subquery()
+        row = db.session.query(has_special_status, testing_food_id).one()
+        return bool(row[0]), row[1]
+    except OperationalError as e:
+        logger.error(f"get_new_food_blockers error: {e}")
+        return False, None
+
+
 def create_special_status(
     baby_id: int,
     status_type: str,
     created_by: int,
     description: str = None,
-    duration_days: int = 14
+    duration_days: int = 14,
+    commit: bool = True
 ) -> Optional[SpecialStatus]:
     """创建特殊状态"""
     try:
@@ -528,7 +869,7 @@ def create_special_status(
             SpecialStatus.is_active == True
         ).update({'is_active': False})
 
-        today = date.today()
+        today = clock.today()
         end_date = today + timedelta(days=duration_days)
 
         status = SpecialStatus(
@@ -540,27 +881,27 @@ def create_special_status(
             created_by=created_by
         )
         db.session.add(status)
-        db.session.commit()
+        _commit(commit)
         return status
     except OperationalError as e:
         logger.error(f"create_special_status error: {e}")
-        db.session.rollback()
+        _handle_write_error(commit, e)
         return None
 
 
-def end_special_status(status_id: int) -> bool:
+def end_special_status(status_id: int, commit: bool = True) -> bool:
     """结束特殊状态"""
     try:
         status = SpecialStatus.query.get(status_id)
         if status:
             status.is_active = False
-            status.end_date = date.today()
-            db.session.commit()
+            status.end_date = clock.today()
+            _commit(commit)
             return True
         return False
     except OperationalError as e:
         logger.error(f"end_special_status error: {e}")
-        db.session.rollback()
+        _handle_write_error(commit, e)
         return False
 
 
@@ -582,11 +923,12 @@ def create_invitation(
     inviter_id: int,
     code: str,
     expires_hours: int = 24,
-    max_uses: int = 1
+    max_uses: int = 1,
+    commit: bool = True
 ) -> Optional[Invitation]:
     """创建邀请"""
     try:
-        expires_at = datetime.now() + timedelta(hours=expires_hours)
+        expires_at = clock.now() + timedelta(hours=expires_hours)
 
         invitation = Invitation(
             code=code,
@@ -596,25 +938,40 @@ def create_invitation(
             max_uses=max_uses
         )
         db.session.add(invitation)
-        db.session.commit()
+        _commit(commit)
         return invitation
     except OperationalError as e:
         logger.error(f"create_invitation error: {e}")
-        db.session.rollback()
+        _handle_write_error(commit, e)
         return None
 
 
-def use_invitation(invitation: Invitation) -> bool:
-    """使用邀请（增加使用次数）"""
+def use_invitation(invitation: Invitation, commit: bool = True) -> bool:
+    """使用邀请（增加使用次数）
+
+    使用单条条件UPDATE原子地增加次数，并发接受同一邀请时不会丢失更新；
+    邀请已失效或次数已用完时返回False
+    """
     try:
-        invitation.used_count += 1
-        if invitation.used_count >= invitation.max_uses:
-            invitation.is_active = False
-        db.session.commit()
-        return True
+        result = db.session.execute(
+            update(Invitation).where(
+                Invitation.id == invitation.id,
+                Invitation.is_active == True,
+                Invitation.used_count < Invitation.max_uses
+            ).ordered_values(
+                # MySQL 按顺序执行 SET 赋值，is_active 须在 used_count 自增之前计算
+                (Invitation.is_active, case(
+                    (Invitation.used_count + 1 >= Invitation.max_uses, False),
+                    else_=Invitation.is_active
+                )),
+                (Invitation.used_count, Invitation.used_count + 1)
+            ).execution_options(synchronize_session=False)
+        )
+        _commit(commit)
+        return result.rowcount == 1
     except OperationalError as e:
         logger.error(f"use_invitation error: {e}")
-        db.session.rollback()
+        _handle_write_error(commit, e)
         return False
 
 
@@ -624,15 +981,28 @@ def use_invitation(invitation: Invitation) -> bool:
 
 def get_food_by_name(name: str) -> Optional[Food]:
     """根据名称获取食材"""
-    try:
-        return Food.query.filter(Food.name == name, Food.is_active == True).first()
-    except OperationalError as e:
-        logger.error(f"get_food_by_name error: {e}")
+    cache = _food_catalog()
+    if cache is None:
         return None
+    return cache['by_name'].get(name)
+
+
+def get_foods_by_names(names: List[str]) -> Dict[str, Food]:
+    """根据名称列表批量获取食材，返回 {名称: 食材}，未找到的名称不在结果中"""
+    if not names:
+        return {}
+    cache = _food_catalog()
+    if cache is None:
+        return {}
+    by_name = cache['by_name']
+    return {name: by_name[name] for name in names if name in by_name}
+
 
+def batch_create_meal_plans(plans: List[dict], baby_id: int, created_by: int, commit: bool = True) -> int:
+    """批量创建辅食计划（已存在的日期+餐次会跳过）
 
-def batch_create_meal_plans(plans: List[dict], baby_id: int, created_by: int) -> int:
-    """批量创建辅食计划
+    一次查询已有计划，计划和食材各用一条executemany批量插入，
+    插入后按(日期, 餐次)回查新计划ID
 
     Args:
         plans: 计划列表，每个元素包含 plan_date, meal_type, food_ids, new_food_id(可选)
@@ -642,29 +1012,68 @@ def batch_create_meal_plans(plans: List[dict], baby_id: int, created_by: int) ->
     Returns:
         成功创建的计划数量
     """
+    if not plans:
+        return 0
+
     try:
-        count = 0
-        for plan_data in plans:
-            # 检查是否已存在
-            existing = get_meal_plan(baby_id, plan_data['plan_date'], plan_data['meal_type'])
-            if existing:
-                continue
+        start_date = min(p['plan_date'] for p in plans)
+        end_date = max(p['plan_date'] for p in plans)
+        date_range = (
+            MealPlan.baby_id == baby_id,
+            MealPlan.plan_date >= start_date,
+            MealPlan.plan_date <= end_date
+        )
 
-            plan = MealPlan(
-                baby_id=baby_id,
-                plan_date=plan_data['plan_date'],
-                meal_type=plan_data['meal_type'],
-                food_ids=','.join(str(fid) for fid in plan_data['food_ids']),
-                new_food_id=plan_data.get('new_food_id'),
-                is_ai_generated=True,
-                created_by=created_by
-            )
-            db.session.add(plan)
-            count += 1
+        # 一次查出范围内已存在的计划
+        existing = set(
+            db.session.query(MealPlan.plan_date, MealPlan.meal_type).filter(*date_range)
+        )
 
-        db.session.commit()
-        return count
+        new_plans = {}
+        for plan_data in plans:
+            key = (plan_data['plan_date'], plan_data['meal_type'])
+            if key in existing or key in new_plans:
+                continue
+            new_plans[key] = plan_data
+
+        if not new_plans:
+            return 0
+
+        now = clock.now()
+        mark_baby_changed(baby_id)
+        db.session.execute(insert(MealPlan.__table__), [
+            {
+                'baby_id': baby_id,
+                'plan_date': plan_date,
+                'meal_type': meal_type,
+                'new_food_id': plan_data.get('new_food_id'),
+                'is_ai_generated': True,
+                'is_completed': False,
+                'created_by': created_by,
+                'created_at': now,
+                'updated_at': now
+            }
+            for (plan_date, meal_type), plan_data in new_plans.items()
+        ])
+
+        # 回查新计划ID，批量写入食材
+        plan_ids = {
+            (plan_date, meal_type): plan_id
+            for plan_id, plan_date, meal_type in db.session.query(
+                MealPlan.id, MealPlan.plan_date, MealPlan.meal_type
+            ).filter(*date_range)
+        }
+        food_rows = [
+            {'plan_id': plan_ids[key], 'position': position, 'food_id': food_id}
+            for key, plan_data in new_plans.items()
+            for position, food_id in enumerate(plan_data['food_ids'])
+        ]
+        if food_rows:
+            db.session.execute(insert(MealPlanFood.__table__), food_rows)
+
+        _commit(commit)
+        return len(new_plans)
     except SQLAlchemyError as e:
         logger.error(f"batch_create_meal_plans error: {e}")
-        db.session.rollback()
+        _handle_write_error(commit, e)
         return 0
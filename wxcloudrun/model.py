@@ -1,6 +1,12 @@
 from datetime import datetime, date
+from operator import attrgetter
+from typing import Optional
+
+from sqlalchemy import func
+from sqlalchemy.ext.hybrid import hybrid_property
 
 from wxcloudrun import db
+from wxcloudrun.utils import clock
 
 
 # ==========================================
@@ -21,15 +27,12 @@ class User(db.Model):
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
     updated_at = db.Column(db.DateTime, nullable=False, default=datetime.now, onupdate=datetime.now)
 
+    # 序列化字段（日期时间保持原始类型，由JSON序列化统一处理）
+    _FIELDS = ('id', 'openid', 'nickname', 'avatar_url', 'current_baby_id', 'created_at')
+    _GETTER = attrgetter(*_FIELDS)
+
     def to_dict(self):
-        return {
-            'id': self.id,
-            'openid': self.openid,
-            'nickname': self.nickname,
-            'avatar_url': self.avatar_url,
-            'current_baby_id': self.current_baby_id,
-            'created_at': self.created_at.isoformat() if self.created_at else None
-        }
+        return dict(zip(self._FIELDS, self._GETTER(self)))
 
 
 # ==========================================
@@ -49,34 +52,46 @@ class Baby(db.Model):
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
     updated_at = db.Column(db.DateTime, nullable=False, default=datetime.now, onupdate=datetime.now)
 
+    # 管理员关系（表上无外键约束，通过 foreign() 指定关联列）
+    managers = db.relationship(
+        'BabyManager',
+        primaryjoin='Baby.id == foreign(BabyManager.baby_id)',
+        cascade='all'
+    )
+
+    @hybrid_property
+    def birthday_ym(self) -> int:
+        """出生年月序号（年*12+月）"""
+        return self.birthday.year * 12 + self.birthday.month
+
+    @birthday_ym.expression
+    def birthday_ym(cls):
+        return func.year(cls.birthday) * 12 + func.month(cls.birthday)
+
     def get_age_months(self) -> int:
-        """计算月龄"""
-        today = date.today()
-        months = (today.year - self.birthday.year) * 12 + (today.month - self.birthday.month)
-        if today.day < self.birthday.day:
-            months -= 1
+        """计算月龄（未满当月生日日期的不计入）"""
+        birthday = self.birthday
+        months = clock.today_ym() - self.birthday_ym - (clock.today().day < birthday.day)
         return max(0, months)
 
     def get_age_days(self) -> int:
         """计算天数"""
-        today = date.today()
-        return (today - self.birthday).days
-
-    def to_dict(self, include_age=True):
-        result = {
-            'id': self.id,
-            'name': self.name,
-            'avatar': self.avatar,
-            'birthday': self.birthday.isoformat() if self.birthday else None,
-            'gender': self.gender,
-            'allergy_notes': self.allergy_notes,
-            'food_preferences': self.food_preferences,
-            'created_by': self.created_by,
-            'created_at': self.created_at.isoformat() if self.created_at else None
-        }
+        return (clock.today() - self.birthday).days
+
+    _FIELDS = (
+        'id', 'name', 'avatar', 'birthday', 'gender', 'allergy_notes',
+        'food_preferences', 'created_by', 'created_at'
+    )
+    _GETTER = attrgetter(*_FIELDS)
+
+    def to_dict(self, include_age=True, extra: Optional[dict] = None):
+        """extra: 追加到结果中的字段，省去调用方再复制一次字典"""
+        result = dict(zip(self._FIELDS, self._GETTER(self)))
         if include_age:
             result['age_months'] = self.get_age_months()
             result['age_days'] = self.get_age_days()
+        if extra:
+            result.update(extra)
         return result
 
 
@@ -85,23 +100,25 @@ class Baby(db.Model):
 # ==========================================
 class BabyManager(db.Model):
     __tablename__ = 'baby_managers'
+    __table_args__ = (
+        db.Index('idx_user_baby', 'user_id', 'baby_id'),
+    )
+
+    # 角色取值
+    ROLES = ('owner', 'manager')
 
     id = db.Column(db.BigInteger, primary_key=True, autoincrement=True)
     baby_id = db.Column(db.BigInteger, nullable=False)
     user_id = db.Column(db.BigInteger, nullable=False)
-    role = db.Column(db.Enum('owner', 'manager'), nullable=False, default='manager')
+    role = db.Column(db.Enum(*ROLES), nullable=False, default='manager')
     invited_by = db.Column(db.BigInteger, nullable=True)
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
 
+    _FIELDS = ('id', 'baby_id', 'user_id', 'role', 'invited_by', 'created_at')
+    _GETTER = attrgetter(*_FIELDS)
+
     def to_dict(self):
-        return {
-            'id': self.id,
-            'baby_id': self.baby_id,
-            'user_id': self.user_id,
-            'role': self.role,
-            'invited_by': self.invited_by,
-            'created_at': self.created_at.isoformat() if self.created_at else None
-        }
+        return dict(zip(self._FIELDS, self._GETTER(self)))
 
 
 # ==========================================
@@ -110,9 +127,12 @@ class BabyManager(db.Model):
 class Food(db.Model):
     __tablename__ = 'foods'
 
+    # 分类取值（按展示顺序）
+    CATEGORIES = ('staple', 'vegetable', 'fruit', 'meat', 'dairy', 'seafood')
+
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.String(32), nullable=False)
-    category = db.Column(db.Enum('staple', 'vegetable', 'fruit', 'meat', 'dairy', 'seafood'), nullable=False)
+    category = db.Column(db.Enum(*CATEGORIES), nullable=False)
     min_month = db.Column(db.SmallInteger, nullable=False, default=6)
     max_month = db.Column(db.SmallInteger, nullable=True)
     allergy_risk = db.Column(db.SmallInteger, nullable=False, default=0)  # 0=低，1=中，2=高
@@ -134,21 +154,16 @@ class Food(db.Model):
         'seafood': '海鲜'
     }
 
+    _FIELDS = (
+        'id', 'name', 'category', 'min_month', 'max_month', 'allergy_risk',
+        'nutrition_info', 'cooking_tips', 'icon', 'is_active', 'sort_order'
+    )
+    _GETTER = attrgetter(*_FIELDS)
+
     def to_dict(self):
-        return {
-            'id': self.id,
-            'name': self.name,
-            'category': self.category,
-            'category_name': self.CATEGORY_NAMES.get(self.category, self.category),
-            'min_month': self.min_month,
-            'max_month': self.max_month,
-            'allergy_risk': self.allergy_risk,
-            'nutrition_info': self.nutrition_info,
-            'cooking_tips': self.cooking_tips,
-            'icon': self.icon,
-            'is_active': self.is_active,
-            'sort_order': self.sort_order
-        }
+        result = dict(zip(self._FIELDS, self._GETTER(self)))
+        result['category_name'] = self.CATEGORY_NAMES.get(self.category, self.category)
+        return result
 
 
 # ==========================================
@@ -156,11 +171,18 @@ class Food(db.Model):
 # ==========================================
 class BabyFoodStatus(db.Model):
     __tablename__ = 'baby_food_status'
+    __table_args__ = (
+        db.UniqueConstraint('baby_id', 'food_id', name='uk_baby_food'),
+        db.Index('idx_baby_status_end', 'baby_id', 'status', 'testing_end_date'),
+    )
+
+    # 状态取值
+    STATUSES = ('safe', 'allergic', 'testing')
 
     id = db.Column(db.BigInteger, primary_key=True, autoincrement=True)
     baby_id = db.Column(db.BigInteger, nullable=False)
     food_id = db.Column(db.Integer, nullable=False)
-    status = db.Column(db.Enum('safe', 'allergic', 'testing'), nullable=False, default='testing')
+    status = db.Column(db.Enum(*STATUSES), nullable=False, default='testing')
     testing_start_date = db.Column(db.Date, nullable=True)
     testing_end_date = db.Column(db.Date, nullable=True)
     allergy_count = db.Column(db.Integer, nullable=False, default=0)
@@ -170,28 +192,24 @@ class BabyFoodStatus(db.Model):
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
     updated_at = db.Column(db.DateTime, nullable=False, default=datetime.now, onupdate=datetime.now)
 
-    def get_testing_days_remaining(self) -> int:
-        """获取排敏剩余天数"""
+    def get_testing_days_remaining(self, today: Optional[date] = None) -> int:
+        """获取排敏剩余天数；批量计算时可传入 today，默认取请求内缓存的日期"""
         if self.status != 'testing' or not self.testing_end_date:
             return 0
-        today = date.today()
-        remaining = (self.testing_end_date - today).days
-        return max(0, remaining)
-
-    def to_dict(self):
-        return {
-            'id': self.id,
-            'baby_id': self.baby_id,
-            'food_id': self.food_id,
-            'status': self.status,
-            'testing_start_date': self.testing_start_date.isoformat() if self.testing_start_date else None,
-            'testing_end_date': self.testing_end_date.isoformat() if self.testing_end_date else None,
-            'testing_days_remaining': self.get_testing_days_remaining(),
-            'allergy_count': self.allergy_count,
-            'allergy_symptoms': self.allergy_symptoms,
-            'notes': self.notes,
-            'updated_at': self.updated_at.isoformat() if self.updated_at else None
-        }
+        return max(0, (self.testing_end_date - (today or clock.today())).days)
+
+    _FIELDS = (
+        'id', 'baby_id', 'food_id', 'status', 'testing_start_date', 'testing_end_date',
+        'allergy_count', 'allergy_symptoms', 'notes', 'updated_at'
+    )
+    _GETTER = attrgetter(*_FIELDS)
+
+    def to_dict(self, extra: Optional[dict] = None):
+        result = dict(zip(self._FIELDS, self._GETTER(self)))
+        result['testing_days_remaining'] = self.get_testing_days_remaining()
+        if extra:
+            result.update(extra)
+        return result
 
 
 # ==========================================
@@ -199,12 +217,17 @@ class BabyFoodStatus(db.Model):
 # ==========================================
 class MealPlan(db.Model):
     __tablename__ = 'meal_plans'
+    __table_args__ = (
+        db.UniqueConstraint('baby_id', 'plan_date', 'meal_type', name='uk_baby_date_type'),
+    )
+
+    # 餐次取值
+    MEAL_TYPES = ('breakfast', 'lunch', 'dinner', 'snack')
 
     id = db.Column(db.BigInteger, primary_key=True, autoincrement=True)
     baby_id = db.Column(db.BigInteger, nullable=False)
     plan_date = db.Column(db.Date, nullable=False)
-    meal_type = db.Column(db.Enum('breakfast', 'lunch', 'dinner', 'snack'), nullable=False, default='lunch')
-    food_ids = db.Column(db.String(255), nullable=False)  # 逗号分隔的食材ID
+    meal_type = db.Column(db.Enum(*MEAL_TYPES), nullable=False, default='lunch')
     new_food_id = db.Column(db.Integer, nullable=True)  # 新添加的食材ID
     is_ai_generated = db.Column(db.Boolean, nullable=False, default=False)
     notes = db.Column(db.String(255), nullable=True)
@@ -214,6 +237,31 @@ class MealPlan(db.Model):
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
     updated_at = db.Column(db.DateTime, nullable=False, default=datetime.now, onupdate=datetime.now)
 
+    # 食材列表（按position排序），selectin方式批量加载避免N+1
+    foods = db.relationship(
+        'MealPlanFood',
+        primaryjoin='MealPlan.id == foreign(MealPlanFood.plan_id)',
+        order_by='MealPlanFood.position',
+        cascade='all, delete-orphan',
+        lazy='selectin'
+    )
+
+    # 新添加的食材（只读）
+    new_food = db.relationship(
+        'Food',
+        primaryjoin='foreign(MealPlan.new_food_id) == Food.id',
+        viewonly=True
+    )
+
+    # 宝宝对新食材的状态（只读，用于计算排敏天数）
+    new_food_status = db.relationship(
+        'BabyFoodStatus',
+        primaryjoin='and_(foreign(MealPlan.baby_id) == BabyFoodStatus.baby_id, '
+                    'foreign(MealPlan.new_food_id) == BabyFoodStatus.food_id)',
+        uselist=False,
+        viewonly=True
+    )
+
     # 餐次中文名称映射
     MEAL_TYPE_NAMES = {
         'breakfast': '早餐',
@@ -224,30 +272,49 @@ class MealPlan(db.Model):
 
     def get_food_id_list(self) -> list:
         """获取食材ID列表"""
-        if not self.food_ids:
-            return []
-        return [int(fid) for fid in self.food_ids.split(',') if fid.strip()]
+        return [item.food_id for item in self.foods]
 
     def set_food_id_list(self, food_ids: list):
         """设置食材ID列表"""
-        self.food_ids = ','.join(str(fid) for fid in food_ids)
+        self.foods = [
+            MealPlanFood(position=position, food_id=food_id)
+            for position, food_id in enumerate(food_ids)
+        ]
+
+    _FIELDS = (
+        'id', 'baby_id', 'plan_date', 'meal_type', 'new_food_id', 'is_ai_generated',
+        'notes', 'is_completed', 'completed_at', 'created_by', 'created_at'
+    )
+    _GETTER = attrgetter(*_FIELDS)
+
+    def to_dict(self, extra: Optional[dict] = None):
+        result = dict(zip(self._FIELDS, self._GETTER(self)))
+        result['meal_type_name'] = self.MEAL_TYPE_NAMES.get(self.meal_type, self.meal_type)
+        result['food_ids'] = self.get_food_id_list()
+        if extra:
+            result.update(extra)
+        return result
 
-    def to_dict(self):
-        return {
-            'id': self.id,
-            'baby_id': self.baby_id,
-            'plan_date': self.plan_date.isoformat() if self.plan_date else None,
-            'meal_type': self.meal_type,
-            'meal_type_name': self.MEAL_TYPE_NAMES.get(self.meal_type, self.meal_type),
-            'food_ids': self.get_food_id_list(),
-            'new_food_id': self.new_food_id,
-            'is_ai_generated': self.is_ai_generated,
-            'notes': self.notes,
-            'is_completed': self.is_completed,
-            'completed_at': self.completed_at.isoformat() if self.completed_at else None,
-            'created_by': self.created_by,
-            'created_at': self.created_at.isoformat() if self.created_at else None
-        }
+
+# ==========================================
+# 辅食计划食材关联表
+# ==========================================
+class MealPlanFood(db.Model):
+    __tablename__ = 'meal_plan_foods'
+    __table_args__ = (
+        db.Index('idx_food_id', 'food_id'),
+    )
+
+    plan_id = db.Column(db.BigInteger, primary_key=True)
+    position = db.Column(db.SmallInteger, primary_key=True)  # 食材在计划中的顺序
+    food_id = db.Column(db.Integer, nullable=False)
+
+    # 关联食材（只读）
+    food = db.relationship(
+        'Food',
+        primaryjoin='foreign(MealPlanFood.food_id) == Food.id',
+        viewonly=True
+    )
 
 
 # ==========================================
@@ -255,10 +322,16 @@ class MealPlan(db.Model):
 # ==========================================
 class SpecialStatus(db.Model):
     __tablename__ = 'special_status'
+    __table_args__ = (
+        db.Index('idx_baby_active_end', 'baby_id', 'is_active', 'end_date'),
+    )
+
+    # 状态类型取值
+    STATUS_TYPES = ('sick', 'vaccine', 'other')
 
     id = db.Column(db.BigInteger, primary_key=True, autoincrement=True)
     baby_id = db.Column(db.BigInteger, nullable=False)
-    status_type = db.Column(db.Enum('sick', 'vaccine', 'other'), nullable=False)
+    status_type = db.Column(db.Enum(*STATUS_TYPES), nullable=False)
     start_date = db.Column(db.Date, nullable=False)
     end_date = db.Column(db.Date, nullable=False)
     description = db.Column(db.String(255), nullable=True)
@@ -274,28 +347,23 @@ class SpecialStatus(db.Model):
         'other': '其他'
     }
 
-    def get_days_remaining(self) -> int:
-        """获取剩余天数"""
+    def get_days_remaining(self, today: Optional[date] = None) -> int:
+        """获取剩余天数；批量计算时可传入 today，默认取请求内缓存的日期"""
         if not self.is_active or not self.end_date:
             return 0
-        today = date.today()
-        remaining = (self.end_date - today).days
-        return max(0, remaining)
+        return max(0, (self.end_date - (today or clock.today())).days)
+
+    _FIELDS = (
+        'id', 'baby_id', 'status_type', 'start_date', 'end_date', 'description',
+        'is_active', 'created_by', 'created_at'
+    )
+    _GETTER = attrgetter(*_FIELDS)
 
     def to_dict(self):
-        return {
-            'id': self.id,
-            'baby_id': self.baby_id,
-            'status_type': self.status_type,
-            'status_type_name': self.STATUS_TYPE_NAMES.get(self.status_type, self.status_type),
-            'start_date': self.start_date.isoformat() if self.start_date else None,
-            'end_date': self.end_date.isoformat() if self.end_date else None,
-            'days_remaining': self.get_days_remaining(),
-            'description': self.description,
-            'is_active': self.is_active,
-            'created_by': self.created_by,
-            'created_at': self.created_at.isoformat() if self.created_at else None
-        }
+        result = dict(zip(self._FIELDS, self._GETTER(self)))
+        result['status_type_name'] = self.STATUS_TYPE_NAMES.get(self.status_type, self.status_type)
+        result['days_remaining'] = self.get_days_remaining()
+        return result
 
 
 # ==========================================
@@ -303,6 +371,9 @@ class SpecialStatus(db.Model):
 # ==========================================
 class Invitation(db.Model):
     __tablename__ = 'invitations'
+    __table_args__ = (
+        db.Index('idx_baby_active_expires', 'baby_id', 'is_active', 'expires_at'),
+    )
 
     id = db.Column(db.BigInteger, primary_key=True, autoincrement=True)
     code = db.Column(db.String(32), unique=True, nullable=False)
@@ -324,16 +395,13 @@ class Invitation(db.Model):
             return False
         return True
 
+    _FIELDS = (
+        'id', 'code', 'baby_id', 'inviter_id', 'expires_at', 'max_uses',
+        'used_count', 'is_active', 'created_at'
+    )
+    _GETTER = attrgetter(*_FIELDS)
+
     def to_dict(self):
-        return {
-            'id': self.id,
-            'code': self.code,
-            'baby_id': self.baby_id,
-            'inviter_id': self.inviter_id,
-            'expires_at': self.expires_at.isoformat() if self.expires_at else None,
-            'max_uses': self.max_uses,
-            'used_count': self.used_count,
-            'is_active': self.is_active,
-            'is_valid': self.is_valid(),
-            'created_at': self.created_at.isoformat() if self.created_at else None
-        }
+        result = dict(zip(self._FIELDS, self._GETTER(self)))
+        result['is_valid'] = self.is_valid()
+        return result
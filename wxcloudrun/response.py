@@ -1,21 +1,46 @@
-import json
+from flask import Response, request
 
-from flask import Response
+from wxcloudrun.utils import fastjson
 
 
 def make_succ_empty_response():
-    data = json.dumps({'code': 0, 'data': {}})
+    data = fastjson.dumps({'code': 0, 'data': {}})
     return Response(data, mimetype='application/json')
 
 
 def make_succ_response(data):
-    data = json.dumps({'code': 0, 'data': data})
+    data = fastjson.dumps({'code': 0, 'data': data})
     return Response(data, mimetype='application/json')
 
 
+def make_succ_body(data) -> bytes:
+    """序列化成功响应体（可缓存后交给 make_conditional_body_response 直接返回）"""
+    return fastjson.dumps({'code': 0, 'data': data})
+
+
+def make_conditional_succ_response(data):
+    """带 ETag 的成功响应；客户端 If-None-Match 命中时返回 304 空响应
+
+    ETag 由响应内容计算，数据有任何变化都会更新；Cache-Control 要求客户端每次重新验证，
+    宝宝数据可能被其他管理员修改
+    """
+    return make_conditional_body_response(make_succ_body(data))
+
+
+def make_conditional_body_response(body: bytes):
+    """以已序列化的响应体构建带 ETag 的响应，规则同 make_conditional_succ_response"""
+    response = Response(body, mimetype='application/json')
+    response.add_etag()
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+
 def make_err_response(err_msg, code=-1, error_code=None):
     result = {'code': code, 'errorMsg': err_msg}
     if error_code:
         result['errorCode'] = error_code
-    data = json.dumps(result)
-    return Response(data, mimetype='application/json')
+    data = fastjson.dumps(result)
+    response = Response(data, mimetype='application/json')
+    # 标记为错误响应：请求结束时 commit_session 据此回滚视图中未提交的修改
+    response.is_error = True
+    return response
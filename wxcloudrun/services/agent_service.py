@@ -1,16 +1,18 @@
 """
 Agent 服务 - 核心对话处理逻辑
 """
-import json
 import logging
+import time
+from collections import OrderedDict
 from datetime import datetime
-from typing import Dict, List, Any, Generator, Optional
+from typing import Dict, List, Any, Generator, Iterator, Optional, Tuple
 import threading
 
 from wxcloudrun.model import Baby
 from wxcloudrun.services.context_collector import ContextCollector
 from wxcloudrun.services.llm_service import LLMService
 from wxcloudrun.services.tool_executor import ToolExecutor, TOOLS
+from wxcloudrun.utils import fastjson, redis_client
 
 logger = logging.getLogger('log')
 
@@ -19,53 +21,184 @@ class ConversationStore:
     """
     对话存储 (内存版本)
 
-    生产环境建议使用 Redis 替代
+    未配置 Redis 时使用，仅在当前进程内有效。
+    按对话ID分片，每个分片独立加锁，并用 OrderedDict 维护最近使用顺序，
+    超出容量时直接淘汰最久未使用的对话
     """
 
+    SHARD_COUNT = 16
+
     def __init__(self, max_conversations: int = 1000, ttl_seconds: int = 3600):
-        self._store: Dict[str, Dict] = {}
-        self._lock = threading.Lock()
+        self._shards = [OrderedDict() for _ in range(self.SHARD_COUNT)]
+        self._locks = [threading.Lock() for _ in range(self.SHARD_COUNT)]
         self.max_conversations = max_conversations
         self.ttl_seconds = ttl_seconds
+        self._shard_capacity = max(1, max_conversations // self.SHARD_COUNT)
+
+    def _shard(self, conversation_id: str) -> Tuple[OrderedDict, threading.Lock]:
+        """获取对话所在的分片及其锁"""
+        index = hash(conversation_id) % self.SHARD_COUNT
+        return self._shards[index], self._locks[index]
 
     def get(self, conversation_id: str) -> Optional[Dict]:
         """获取对话"""
-        with self._lock:
-            conv = self._store.get(conversation_id)
-            if conv and self._is_expired(conv):
-                del self._store[conversation_id]
+        shard, lock = self._shard(conversation_id)
+        with lock:
+            conv = shard.get(conversation_id)
+            if conv is None:
                 return None
+            if self._is_expired(conv):
+                del shard[conversation_id]
+                return None
+            shard.move_to_end(conversation_id)
             return conv
 
     def set(self, conversation_id: str, data: Dict):
         """设置对话"""
-        with self._lock:
-            self._cleanup_if_needed()
+        shard, lock = self._shard(conversation_id)
+        with lock:
             data['last_active'] = datetime.now()
-            self._store[conversation_id] = data
+            shard[conversation_id] = data
+            shard.move_to_end(conversation_id)
+            while len(shard) > self._shard_capacity:
+                shard.popitem(last=False)
 
     def update_messages(self, conversation_id: str, messages: List[Dict]):
         """更新对话消息"""
-        with self._lock:
-            if conversation_id in self._store:
-                self._store[conversation_id]['messages'] = messages
-                self._store[conversation_id]['last_active'] = datetime.now()
+        shard, lock = self._shard(conversation_id)
+        with lock:
+            conv = shard.get(conversation_id)
+            if conv is not None:
+                conv['messages'] = messages
+                conv['last_active'] = datetime.now()
+                shard.move_to_end(conversation_id)
 
     def _is_expired(self, conv: Dict) -> bool:
         """检查是否过期"""
         last_active = conv.get('last_active', datetime.min)
         return (datetime.now() - last_active).total_seconds() > self.ttl_seconds
 
-    def _cleanup_if_needed(self):
-        """清理过期对话"""
-        if len(self._store) >= self.max_conversations:
-            expired = [k for k, v in self._store.items() if self._is_expired(v)]
-            for k in expired:
-                del self._store[k]
 
+class RedisConversationStore:
+    """
+    对话存储 (Redis版本)
+
+    每个对话存为一个 Hash（conv:{conversation_id}），消息列表序列化为单个字段，
+    读写均为一次往返，过期由 Redis TTL 处理
+    """
+
+    KEY_PREFIX = 'conv:'
+
+    def __init__(self, client, ttl_seconds: int = 3600):
+        self._redis = client
+        self.ttl_seconds = ttl_seconds
+
+    def get(self, conversation_id: str) -> Optional[Dict]:
+        """获取对话"""
+        try:
+            data = self._redis.hgetall(self.KEY_PREFIX + conversation_id)
+        except redis_client.redis.RedisError as e:
+            logger.error(f"RedisConversationStore get error: {e}")
+            return None
+        if not data:
+            return None
+
+        created_at = data.get(b'created_at')
+        return {
+            'id': conversation_id,
+            'baby_id': int(data[b'baby_id']) if data.get(b'baby_id') else None,
+            'messages': fastjson.loads(data[b'messages']) if data.get(b'messages') else [],
+            'created_at': datetime.fromisoformat(created_at.decode()) if created_at else None
+        }
+
+    def set(self, conversation_id: str, data: Dict):
+        """设置对话"""
+        key = self.KEY_PREFIX + conversation_id
+        mapping = {
+            'baby_id': data.get('baby_id') or '',
+            'messages': fastjson.dumps(data.get('messages', [])),
+            'created_at': data['created_at'].isoformat() if data.get('created_at') else ''
+        }
+        try:
+            pipe = self._redis.pipeline(transaction=False)
+            pipe.hset(key, mapping=mapping)
+            pipe.expire(key, self.ttl_seconds)
+            pipe.execute()
+        except redis_client.redis.RedisError as e:
+            logger.error(f"RedisConversationStore set error: {e}")
+
+    def update_messages(self, conversation_id: str, messages: List[Dict]):
+        """更新对话消息"""
+        key = self.KEY_PREFIX + conversation_id
+        try:
+            pipe = self._redis.pipeline(transaction=False)
+            pipe.hset(key, 'messages', fastjson.dumps(messages))
+            pipe.expire(key, self.ttl_seconds)
+            pipe.execute()
+        except redis_client.redis.RedisError as e:
+            logger.error(f"RedisConversationStore update_messages error: {e}")
+
+
+def _sse(event: Dict[str, Any]) -> bytes:
+    """将事件编码为一条 SSE 消息，视图层直接写出，无需再次序列化"""
+    return b'data: ' + fastjson.dumps(event) + b'\n\n'
+
+
+# 固定内容的结束/错误消息预先编码，流结束时直接写出
+_SSE_DONE = _sse({'type': 'done'})
+_SSE_UNAVAILABLE = _sse({'type': 'error', 'content': '服务暂时不可用'})
+
+
+def _sse_error(chunk: Dict[str, Any]) -> bytes:
+    """编码 LLM 返回的错误事件，无具体内容时使用预编码的默认消息"""
+    content = chunk.get('content')
+    return _sse({'type': 'error', 'content': content}) if content else _SSE_UNAVAILABLE
+
+
+# 文本块合并阈值：累计超过 64 个字符或距上次输出超过 50ms 时输出一次
+TEXT_FLUSH_CHARS = 64
+TEXT_FLUSH_INTERVAL = 0.05
 
-# 全局对话存储
-conversation_store = ConversationStore()
+
+def _coalesce_text(chunks: Iterator[Dict[str, Any]]) -> Generator[Dict[str, Any], None, None]:
+    """合并 LLM 流中连续的小文本块，减少 SSE 写出次数
+
+    非文本块到达前先输出缓冲的文本，保证事件顺序不变
+    """
+    buf = []
+    size = 0
+    last_flush = time.monotonic()
+    for chunk in chunks:
+        if chunk['type'] == 'text':
+            buf.append(chunk['content'])
+            size += len(chunk['content'])
+            now = time.monotonic()
+            if size >= TEXT_FLUSH_CHARS or now - last_flush >= TEXT_FLUSH_INTERVAL:
+                yield {'type': 'text', 'content': ''.join(buf)}
+                buf = []
+                size = 0
+                last_flush = now
+            continue
+
+        if buf:
+            yield {'type': 'text', 'content': ''.join(buf)}
+            buf = []
+            size = 0
+            last_flush = time.monotonic()
+        yield chunk
+
+    if buf:
+        yield {'type': 'text', 'content': ''.join(buf)}
+
+
+# 正在后台总结的对话，避免同一对话重复触发
+_summarizing = set()
+_summarizing_lock = threading.Lock()
+
+
+# 全局对话存储：配置了 Redis 时多实例共享，否则使用进程内存储
+_redis = redis_client.get_redis()
+conversation_store = RedisConversationStore(_redis) if _redis is not None else ConversationStore()
 
 
 class AgentService:
@@ -92,6 +225,25 @@ class AgentService:
 {context}
 """
 
+    # 模板中只有 {context} 会变化，导入时拆分一次，每轮直接拼接
+    _PROMPT_PREFIX, _PROMPT_SUFFIX = SYSTEM_PROMPT.split('{context}')
+
+    ADVANCED_PROMPT_PREFIX = """你是一位专业、友好的育儿顾问。请基于以下宝宝信息，回答家长的问题。
+
+回答要求：
+1. 专业、准确、易懂
+2. 考虑宝宝的月龄给出适合的建议
+3. 如果涉及医学问题，建议咨询专业医生
+4. 语气亲切友好
+
+"""
+
+    SUMMARY_PROMPT = "请将以下家长与辅食助手的对话总结为简洁的要点，保留宝宝的状态、进食、过敏等关键信息，不超过200字。"
+
+    # 每轮只发送最近 8 轮对话；超过 16 轮时把更早的消息压缩为摘要
+    HISTORY_WINDOW = 16
+    SUMMARY_THRESHOLD = 32
+
     def __init__(self, baby: Baby, user_id: int):
         self.baby = baby
         self.user_id = user_id
@@ -103,7 +255,7 @@ class AgentService:
         self,
         message: str,
         conversation_id: str
-    ) -> Generator[Dict[str, Any], None, None]:
+    ) -> Generator[bytes, None, None]:
         """
         流式对话处理
 
@@ -112,7 +264,7 @@ class AgentService:
             conversation_id: 对话ID
 
         Yields:
-            流式响应块:
+            编码好的 SSE 消息 (data: {...json...}\n\n)，事件内容:
             - {'type': 'text', 'content': '...'} - 文本内容
             - {'type': 'tool_calling', 'tool': '...'} - 正在调用工具
             - {'type': 'tool_result', 'tool': '...', 'success': bool, 'result': {...}} - 工具结果
@@ -131,54 +283,50 @@ class AgentService:
             conversation_store.set(conversation_id, conversation)
 
         # 构建消息列表
-        context_prompt = self.context_collector.to_prompt()
+        context_prompt = self.context_collector.to_prompt_cached()
         system_message = {
             'role': 'system',
-            'content': self.SYSTEM_PROMPT.format(context=context_prompt)
+            'content': self._PROMPT_PREFIX + context_prompt + self._PROMPT_SUFFIX
         }
 
-        # 历史消息 + 当前消息
-        messages = [system_message] + conversation['messages'] + [
-            {'role': 'user', 'content': message}
-        ]
-
-        # 添加用户消息到历史
+        # 添加用户消息到历史，只把最近的窗口发给 LLM
         conversation['messages'].append({'role': 'user', 'content': message})
+        messages = [system_message] + self._history_window(conversation['messages'])
 
         # 调用LLM
         full_content = ''
 
-        for chunk in self.llm_service.chat_stream(messages, tools=TOOLS, model_type='fast'):
+        for chunk in _coalesce_text(self.llm_service.chat_stream(messages, tools=TOOLS, model_type='fast')):
             if chunk['type'] == 'text':
                 full_content += chunk['content']
-                yield {'type': 'text', 'content': chunk['content']}
+                yield _sse({'type': 'text', 'content': chunk['content']})
 
             elif chunk['type'] == 'tool_call':
                 tool = chunk['tool']
                 tool_name = tool.get('name', '')
-                yield {'type': 'tool_calling', 'tool': tool_name}
+                yield _sse({'type': 'tool_calling', 'tool': tool_name})
 
                 # 解析参数
                 try:
-                    arguments = json.loads(tool.get('arguments', '{}'))
-                except json.JSONDecodeError:
+                    arguments = fastjson.loads(tool.get('arguments') or '{}')
+                except ValueError:
                     arguments = {}
 
                 # 执行工具
                 success, result = self.tool_executor.execute(tool_name, arguments)
 
-                yield {
+                yield _sse({
                     'type': 'tool_result',
                     'tool': tool_name,
                     'success': success,
                     'result': result
-                }
+                })
 
                 # 根据工具结果决定下一步
                 if result.get('type') == 'clarification':
                     # 需要追问
                     question = result.get('question', '')
-                    yield {'type': 'text', 'content': question}
+                    yield _sse({'type': 'text', 'content': question})
                     full_content = question
 
                 elif result.get('type') == 'answer':
@@ -194,17 +342,17 @@ class AgentService:
                     note = result.get('note', '')
                     if note:
                         confirm_msg += f"\n\n💡 {note}"
-                    yield {'type': 'text', 'content': confirm_msg}
+                    yield _sse({'type': 'text', 'content': confirm_msg})
                     full_content = confirm_msg
 
                 else:
                     # 工具执行失败
                     error_msg = result.get('error', '操作失败，请稍后重试')
-                    yield {'type': 'text', 'content': f"抱歉，{error_msg}"}
+                    yield _sse({'type': 'text', 'content': f"抱歉，{error_msg}"})
                     full_content = f"抱歉，{error_msg}"
 
             elif chunk['type'] == 'error':
-                yield {'type': 'error', 'content': chunk.get('content', '服务暂时不可用')}
+                yield _sse_error(chunk)
                 return
 
             elif chunk['type'] == 'done':
@@ -217,41 +365,88 @@ class AgentService:
                 'content': full_content
             })
             conversation_store.update_messages(conversation_id, conversation['messages'])
+            self._maybe_summarize(conversation_id, conversation['messages'])
+
+        yield _SSE_DONE
+
+    def _history_window(self, history: List[Dict]) -> List[Dict]:
+        """取最近 HISTORY_WINDOW 条消息，若更早的消息已被压缩为摘要则一并带上"""
+        window = history[-self.HISTORY_WINDOW:]
+        if len(history) > self.HISTORY_WINDOW and history[0].get('role') == 'system':
+            window = [history[0]] + window
+        return window
+
+    def _maybe_summarize(self, conversation_id: str, history: List[Dict]):
+        """历史消息超过 SUMMARY_THRESHOLD 条时，在后台线程中把较早的消息压缩为摘要"""
+        if len(history) <= self.SUMMARY_THRESHOLD:
+            return
+        with _summarizing_lock:
+            if conversation_id in _summarizing:
+                return
+            _summarizing.add(conversation_id)
+
+        older = history[:-self.HISTORY_WINDOW]
+        threading.Thread(
+            target=self._summarize_history,
+            args=(conversation_id, older),
+            daemon=True
+        ).start()
+
+    def _summarize_history(self, conversation_id: str, older: List[Dict]):
+        """使用快速模型总结较早的对话，并用一条摘要消息替换它们"""
+        try:
+            lines = []
+            for msg in older:
+                if msg.get('role') == 'system':
+                    lines.append(msg.get('content', ''))
+                else:
+                    speaker = '家长' if msg.get('role') == 'user' else '助手'
+                    lines.append(f"{speaker}: {msg.get('content', '')}")
+
+            result = self.llm_service.chat([
+                {'role': 'system', 'content': self.SUMMARY_PROMPT},
+                {'role': 'user', 'content': '\n'.join(lines)}
+            ], model_type='fast')
+            if result['error'] or not result['content']:
+                return
 
-        yield {'type': 'done'}
+            # 总结期间可能有新的消息写入，只替换已被总结的前缀
+            conversation = conversation_store.get(conversation_id)
+            if not conversation or conversation['messages'][:len(older)] != older:
+                return
+            summary = {'role': 'system', 'content': f"此前对话摘要：{result['content']}"}
+            conversation_store.update_messages(
+                conversation_id, [summary] + conversation['messages'][len(older):]
+            )
+        except Exception as e:
+            logger.error(f"summarize conversation {conversation_id} error: {e}", exc_info=True)
+        finally:
+            with _summarizing_lock:
+                _summarizing.discard(conversation_id)
 
     def _answer_with_advanced_model(
         self,
         question: str,
         conversation: Dict,
         context_prompt: str
-    ) -> Generator[Dict[str, Any], None, None]:
+    ) -> Generator[bytes, None, None]:
         """使用高级模型回答复杂问题"""
         system_message = {
             'role': 'system',
-            'content': f"""你是一位专业、友好的育儿顾问。请基于以下宝宝信息，回答家长的问题。
-
-回答要求：
-1. 专业、准确、易懂
-2. 考虑宝宝的月龄给出适合的建议
-3. 如果涉及医学问题，建议咨询专业医生
-4. 语气亲切友好
-
-{context_prompt}
-"""
+            'content': self.ADVANCED_PROMPT_PREFIX + context_prompt + '\n'
         }
 
         messages = [system_message, {'role': 'user', 'content': question}]
 
         full_content = ''
-        for chunk in self.llm_service.chat_stream(messages, model_type='advanced'):
+        for chunk in _coalesce_text(self.llm_service.chat_stream(messages, model_type='advanced')):
             if chunk['type'] == 'text':
                 full_content += chunk['content']
-                yield {'type': 'text', 'content': chunk['content']}
+                yield _sse({'type': 'text', 'content': chunk['content']})
             elif chunk['type'] in ('finish', 'done'):
                 break
             elif chunk['type'] == 'error':
-                yield {'type': 'error', 'content': chunk.get('content', '服务暂时不可用')}
+                yield _sse_error(chunk)
                 return
 
         # 更新对话历史
@@ -261,8 +456,9 @@ class AgentService:
                 'content': full_content
             })
             conversation_store.update_messages(conversation['id'], conversation['messages'])
+            self._maybe_summarize(conversation['id'], conversation['messages'])
 
-        yield {'type': 'done'}
+        yield _SSE_DONE
 
     def get_conversation_messages(self, conversation_id: str) -> List[Dict[str, str]]:
         """获取对话历史消息"""
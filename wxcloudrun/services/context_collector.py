@@ -1,62 +1,86 @@
 """
 上下文收集器 - 为Agent收集宝宝相关上下文信息
 """
-from datetime import date, timedelta, datetime
+import logging
+from datetime import timedelta
 from typing import Dict, List, Any
 
 from wxcloudrun import dao
 from wxcloudrun.model import Baby, MealPlan, SpecialStatus
+from wxcloudrun.utils import clock, concurrency, redis_client
+
+logger = logging.getLogger('log')
+
+# 性别名称，按 Baby.gender 取值(0未知/1男/2女)索引
+_GENDER_NAMES = ('宝宝', '男宝', '女宝')
 
 
 class ContextCollector:
     """上下文收集器 - 收集宝宝相关信息作为Agent的上下文"""
 
+    # Prompt缓存时间（秒）
+    PROMPT_CACHE_TTL = 300
+
+    # Prompt 中展示的食材名称数量上限
+    SAFE_FOODS_LIMIT = 10
+    ALLERGIC_FOODS_LIMIT = 50
+
     def __init__(self, baby: Baby, user_id: int):
         self.baby = baby
         self.user_id = user_id
 
     def collect(self) -> Dict[str, Any]:
-        """收集完整上下文"""
+        """收集完整上下文
+
+        宝宝基础信息在当前线程读取（同时确保 self.baby 的属性已加载），
+        其余相互独立的查询并行执行
+        """
+        baby_info = self._get_baby_info()
+        recent_meals, future_meals, recent_events, food_status_summary = concurrency.run_parallel(
+            self._get_recent_meals,
+            self._get_future_meals,
+            self._get_recent_events,
+            self._get_food_status_summary
+        )
         return {
-            'baby_info': self._get_baby_info(),
-            'recent_meals': self._get_recent_meals(),
-            'future_meals': self._get_future_meals(),
-            'recent_events': self._get_recent_events(),
-            'food_status_summary': self._get_food_status_summary(),
-            'current_date': date.today().isoformat(),
-            'current_time': datetime.now().strftime('%H:%M')
+            'baby_info': baby_info,
+            'recent_meals': recent_meals,
+            'future_meals': future_meals,
+            'recent_events': recent_events,
+            'food_status_summary': food_status_summary,
+            'current_date': clock.today(),
+            'current_time': clock.now().strftime('%H:%M')
         }
 
     def _get_baby_info(self) -> Dict[str, Any]:
         """获取宝宝基础信息"""
-        gender_map = {0: '宝宝', 1: '男宝', 2: '女宝'}
+        gender = self.baby.gender
         return {
             'name': self.baby.name,
             'age_months': self.baby.get_age_months(),
-            'gender': gender_map.get(self.baby.gender, '宝宝'),
-            'birthday': self.baby.birthday.isoformat() if self.baby.birthday else None,
+            'gender': _GENDER_NAMES[gender] if gender in (0, 1, 2) else '宝宝',
+            'birthday': self.baby.birthday,
             'allergy_notes': self.baby.allergy_notes,
             'food_preferences': self.baby.food_preferences
         }
 
     def _get_recent_meals(self) -> List[Dict[str, Any]]:
         """获取过去7天的辅食记录"""
-        today = date.today()
+        today = clock.today()
         start_date = today - timedelta(days=7)
         plans = dao.get_meal_plans_by_date_range(
             self.baby.id, start_date, today - timedelta(days=1)
         )
 
+        meal_type_names = MealPlan.MEAL_TYPE_NAMES
         result = []
         for plan in plans:
-            food_ids = plan.get_food_id_list()
-            foods = dao.get_foods_by_ids(food_ids)
-            food_names = [f.name for f in foods]
+            food_names = [item.food.name for item in plan.foods if item.food]
 
             result.append({
-                'date': plan.plan_date.isoformat() if plan.plan_date else None,
+                'date': plan.plan_date,
                 'meal_type': plan.meal_type,
-                'meal_type_name': MealPlan.MEAL_TYPE_NAMES.get(plan.meal_type, plan.meal_type),
+                'meal_type_name': meal_type_names.get(plan.meal_type, plan.meal_type),
                 'foods': food_names,
                 'is_completed': plan.is_completed
             })
@@ -65,25 +89,21 @@ class ContextCollector:
 
     def _get_future_meals(self) -> List[Dict[str, Any]]:
         """获取未来7天的辅食计划"""
-        today = date.today()
+        today = clock.today()
         end_date = today + timedelta(days=7)
         plans = dao.get_meal_plans_by_date_range(self.baby.id, today, end_date)
 
+        meal_type_names = MealPlan.MEAL_TYPE_NAMES
         result = []
         for plan in plans:
-            food_ids = plan.get_food_id_list()
-            foods = dao.get_foods_by_ids(food_ids)
-            food_names = [f.name for f in foods]
+            food_names = [item.food.name for item in plan.foods if item.food]
 
-            new_food_name = None
-            if plan.new_food_id:
-                new_food = dao.get_food_by_id(plan.new_food_id)
-                new_food_name = new_food.name if new_food else None
+            new_food_name = plan.new_food.name if plan.new_food else None
 
             result.append({
-                'date': plan.plan_date.isoformat() if plan.plan_date else None,
+                'date': plan.plan_date,
                 'meal_type': plan.meal_type,
-                'meal_type_name': MealPlan.MEAL_TYPE_NAMES.get(plan.meal_type, plan.meal_type),
+                'meal_type_name': meal_type_names.get(plan.meal_type, plan.meal_type),
                 'foods': food_names,
                 'new_food': new_food_name
             })
@@ -93,6 +113,7 @@ class ContextCollector:
     def _get_recent_events(self) -> List[Dict[str, Any]]:
         """获取近期事件(特殊状态、过敏记录、排敏中的食材)"""
         events = []
+        today = clock.today()
 
         # 当前特殊状态
         special_status = dao.get_active_special_status(self.baby.id)
@@ -103,123 +124,176 @@ class ContextCollector:
                 'status_name': SpecialStatus.STATUS_TYPE_NAMES.get(
                     special_status.status_type, special_status.status_type
                 ),
-                'start_date': special_status.start_date.isoformat() if special_status.start_date else None,
-                'end_date': special_status.end_date.isoformat() if special_status.end_date else None,
-                'days_remaining': special_status.get_days_remaining(),
+                'start_date': special_status.start_date,
+                'end_date': special_status.end_date,
+                'days_remaining': special_status.get_days_remaining(today),
                 'description': special_status.description
             })
 
-        # 正在排敏的食材
         testing_food = dao.get_baby_testing_food(self.baby.id)
+        # 最近更新的3条过敏记录，按时间正序展示
+        allergic_statuses = dao.get_baby_food_statuses(self.baby.id, status='allergic', limit=3)[::-1]
+
+        # 排敏食材与过敏食材一次性批量查询
+        food_ids = [s.food_id for s in allergic_statuses]
+        if testing_food:
+            food_ids.append(testing_food.food_id)
+        food_by_id = {food.id: food for food in dao.get_foods_by_ids(food_ids)}
+
+        # 正在排敏的食材
         if testing_food:
-            food = dao.get_food_by_id(testing_food.food_id)
+            food = food_by_id.get(testing_food.food_id)
             events.append({
                 'type': 'food_testing',
                 'food_name': food.name if food else '未知',
-                'start_date': testing_food.testing_start_date.isoformat() if testing_food.testing_start_date else None,
-                'end_date': testing_food.testing_end_date.isoformat() if testing_food.testing_end_date else None,
-                'days_remaining': testing_food.get_testing_days_remaining()
+                'start_date': testing_food.testing_start_date,
+                'end_date': testing_food.testing_end_date,
+                'days_remaining': testing_food.get_testing_days_remaining(today)
             })
 
         # 最近的过敏记录(最近3条)
-        allergic_statuses = dao.get_baby_food_statuses(self.baby.id, status='allergic')
-        for status in allergic_statuses[-3:]:
-            food = dao.get_food_by_id(status.food_id)
+        for status in allergic_statuses:
+            food = food_by_id.get(status.food_id)
             events.append({
                 'type': 'allergy',
                 'food_name': food.name if food else '未知',
                 'symptoms': status.allergy_symptoms,
-                'date': status.updated_at.date().isoformat() if status.updated_at else None
+                'date': status.updated_at.date() if status.updated_at else None
             })
 
         return events
 
     def _get_food_status_summary(self) -> Dict[str, Any]:
-        """获取食材状态摘要"""
-        all_statuses = dao.get_baby_food_statuses(self.baby.id)
+        """获取食材状态摘要
+
+        数量由按状态分组计数得到；名称只取 Prompt 中会展示的部分
+        （最近的 SAFE_FOODS_LIMIT 种安全食材、ALLERGIC_FOODS_LIMIT 种过敏食材）
+        """
+        counts = dao.count_baby_food_statuses(self.baby.id)
+        safe_statuses = dao.get_baby_food_statuses(
+            self.baby.id, status='safe', limit=self.SAFE_FOODS_LIMIT
+        )
+        allergic_statuses = dao.get_baby_food_statuses(
+            self.baby.id, status='allergic', limit=self.ALLERGIC_FOODS_LIMIT
+        )
 
-        safe_foods = []
-        allergic_foods = []
+        food_by_id = {
+            food.id: food
+            for food in dao.get_foods_by_ids(
+                [s.food_id for s in safe_statuses] + [s.food_id for s in allergic_statuses]
+            )
+        }
 
-        for status in all_statuses:
-            food = dao.get_food_by_id(status.food_id)
-            if not food:
-                continue
-            if status.status == 'safe':
-                safe_foods.append(food.name)
-            elif status.status == 'allergic':
-                allergic_foods.append(food.name)
+        safe_foods = [food_by_id[s.food_id].name for s in safe_statuses if s.food_id in food_by_id]
+        allergic_foods = [food_by_id[s.food_id].name for s in allergic_statuses if s.food_id in food_by_id]
 
         return {
-            'safe_count': len(safe_foods),
+            'safe_count': counts.get('safe', 0),
             'safe_foods': safe_foods,
-            'allergic_count': len(allergic_foods),
+            'allergic_count': counts.get('allergic', 0),
             'allergic_foods': allergic_foods
         }
 
+    def to_prompt_cached(self) -> str:
+        """获取上下文Prompt，启用 Redis 时按宝宝数据版本和日期缓存
+
+        宝宝相关数据提交修改后版本号递增，缓存键随之变化，
+        同一对话的连续多轮无需重复查询数据库。
+        缓存中不含当前时间，取出后再拼接，避免返回过时的时刻
+        """
+        version = redis_client.get_baby_version(self.baby.id)
+        if version is None:
+            return self.to_prompt()
+
+        client = redis_client.get_redis()
+        key = f'ctx:{self.baby.id}:{version}:{clock.today().isoformat()}'
+        try:
+            cached = client.get(key)
+        except redis_client.redis.RedisError as e:
+            logger.error(f"to_prompt_cached get error: {e}")
+            return self.to_prompt()
+        if cached is not None:
+            return cached.decode('utf-8') + self._time_prompt()
+
+        prompt = self._data_prompt()
+        try:
+            client.setex(key, self.PROMPT_CACHE_TTL, prompt.encode('utf-8'))
+        except redis_client.redis.RedisError as e:
+            logger.error(f"to_prompt_cached set error: {e}")
+        return prompt + self._time_prompt()
+
     def to_prompt(self) -> str:
         """将上下文转换为Prompt格式"""
+        return self._data_prompt() + self._time_prompt()
+
+    @staticmethod
+    def _time_prompt() -> str:
+        """当前时间部分（每次实时生成，不进缓存）"""
+        return f"\n## 当前时间\n{clock.today()} {clock.now().strftime('%H:%M')}\n"
+
+    def _data_prompt(self) -> str:
+        """宝宝数据部分（只随宝宝数据和日期变化，可缓存）"""
         ctx = self.collect()
+        baby_info = ctx['baby_info']
+        summary = ctx['food_status_summary']
+        parts = []
+        append = parts.append
 
         # 构建宝宝基本信息部分
-        prompt = f"""## 宝宝信息
-- 姓名: {ctx['baby_info']['name']}
-- 月龄: {ctx['baby_info']['age_months']}个月
-- 性别: {ctx['baby_info']['gender']}
-- 出生日期: {ctx['baby_info']['birthday']}
-
-## 当前时间
-{ctx['current_date']} {ctx['current_time']}
-
-## 食材状态
-- 已安全添加: {ctx['food_status_summary']['safe_count']}种"""
-
-        if ctx['food_status_summary']['safe_foods']:
-            safe_display = ', '.join(ctx['food_status_summary']['safe_foods'][:10])
-            if len(ctx['food_status_summary']['safe_foods']) > 10:
-                safe_display += '...'
-            prompt += f" ({safe_display})"
+        parts.extend((
+            "## 宝宝信息\n",
+            f"- 姓名: {baby_info['name']}\n",
+            f"- 月龄: {baby_info['age_months']}个月\n",
+            f"- 性别: {baby_info['gender']}\n",
+            f"- 出生日期: {baby_info['birthday']}\n",
+            "\n## 食材状态\n",
+            f"- 已安全添加: {summary['safe_count']}种",
+        ))
+
+        safe_foods = summary['safe_foods']
+        if safe_foods:
+            append(f" ({', '.join(safe_foods)}{'...' if summary['safe_count'] > len(safe_foods) else ''})")
         else:
-            prompt += " (暂无)"
+            append(" (暂无)")
 
-        prompt += f"\n- 过敏食材: {ctx['food_status_summary']['allergic_count']}种"
-        if ctx['food_status_summary']['allergic_foods']:
-            prompt += f" ({', '.join(ctx['food_status_summary']['allergic_foods'])})"
+        append(f"\n- 过敏食材: {summary['allergic_count']}种")
+        if summary['allergic_foods']:
+            append(f" ({', '.join(summary['allergic_foods'])})")
         else:
-            prompt += " (暂无)"
+            append(" (暂无)")
 
         # 近期事件
-        prompt += "\n\n## 近期事件\n"
+        append("\n\n## 近期事件\n")
         if ctx['recent_events']:
             for event in ctx['recent_events']:
                 if event['type'] == 'special_status':
-                    prompt += f"- 【特殊状态】{event['status_name']}: {event['start_date']} ~ {event['end_date']}, 剩余{event['days_remaining']}天\n"
+                    append(f"- 【特殊状态】{event['status_name']}: {event['start_date']} ~ {event['end_date']}, 剩余{event['days_remaining']}天\n")
                 elif event['type'] == 'food_testing':
-                    prompt += f"- 【排敏中】{event['food_name']}: 剩余{event['days_remaining']}天\n"
+                    append(f"- 【排敏中】{event['food_name']}: 剩余{event['days_remaining']}天\n")
                 elif event['type'] == 'allergy':
                     symptoms = event['symptoms'] or '无症状记录'
-                    prompt += f"- 【过敏记录】{event['food_name']}: {symptoms} ({event['date']})\n"
+                    append(f"- 【过敏记录】{event['food_name']}: {symptoms} ({event['date']})\n")
         else:
-            prompt += "暂无特殊事件\n"
+            append("暂无特殊事件\n")
 
         # 过去7天食谱
-        prompt += "\n## 过去7天食谱\n"
+        append("\n## 过去7天食谱\n")
         if ctx['recent_meals']:
             for meal in ctx['recent_meals']:
                 status = "已完成" if meal['is_completed'] else "未完成"
                 foods_str = ', '.join(meal['foods']) if meal['foods'] else '无'
-                prompt += f"- {meal['date']} {meal['meal_type_name']}: {foods_str} [{status}]\n"
+                append(f"- {meal['date']} {meal['meal_type_name']}: {foods_str} [{status}]\n")
         else:
-            prompt += "暂无记录\n"
+            append("暂无记录\n")
 
         # 未来7天计划
-        prompt += "\n## 未来7天计划\n"
+        append("\n## 未来7天计划\n")
         if ctx['future_meals']:
             for meal in ctx['future_meals']:
                 foods_str = ', '.join(meal['foods']) if meal['foods'] else '无'
                 new_mark = f" 【新食材: {meal['new_food']}】" if meal.get('new_food') else ""
-                prompt += f"- {meal['date']} {meal['meal_type_name']}: {foods_str}{new_mark}\n"
+                append(f"- {meal['date']} {meal['meal_type_name']}: {foods_str}{new_mark}\n")
         else:
-            prompt += "暂无计划\n"
+            append("暂无计划\n")
 
-        return prompt
+        return ''.join(parts)
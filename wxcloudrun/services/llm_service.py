@@ -1,16 +1,32 @@
 """
 LLM 服务封装 - 火山引擎豆包API
 """
-import json
 import logging
 from typing import Dict, List, Any, Generator, Optional
 import requests
+from requests.adapters import HTTPAdapter
 
-from config import VOLCANO_API_KEY
+from config import SETTINGS
+from wxcloudrun.utils import fastjson
 
 logger = logging.getLogger('log')
 
 
+def _build_session() -> requests.Session:
+    """创建进程内共享的 HTTP 会话，复用到方舟 API 的 TCP/TLS 连接"""
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=64))
+    session.headers.update({
+        'Content-Type': 'application/json',
+        'Connection': 'keep-alive',
+        'Authorization': f'Bearer {SETTINGS.VOLCANO_API_KEY}'
+    })
+    return session
+
+
+_session = _build_session()
+
+
 class LLMService:
     """火山引擎豆包LLM服务"""
 
@@ -24,7 +40,7 @@ class LLMService:
     BASE_URL = 'https://ark.cn-beijing.volces.com/api/v3'
 
     def __init__(self):
-        self.api_key = VOLCANO_API_KEY
+        self.api_key = SETTINGS.VOLCANO_API_KEY
 
     def chat_stream(
         self,
@@ -70,44 +86,35 @@ class LLMService:
             payload['tools'] = tools
             payload['tool_choice'] = 'auto'
 
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {self.api_key}'
-        }
-
         try:
-            response = requests.post(
+            with _session.post(
                 f'{self.BASE_URL}/chat/completions',
-                headers=headers,
-                json=payload,
+                data=fastjson.dumps(payload),
                 stream=True,
                 timeout=60
-            )
-            response.raise_for_status()
-
-            # 用于累积工具调用的参数
-            tool_call_accumulator = {}
-
-            for line in response.iter_lines():
-                if not line:
-                    continue
-
-                line = line.decode('utf-8')
-                if not line.startswith('data: '):
-                    continue
-
-                data = line[6:]  # 去掉 'data: ' 前缀
-                if data == '[DONE]':
-                    yield {'type': 'done'}
-                    break
-
-                try:
-                    chunk = json.loads(data)
+            ) as response:
+                response.raise_for_status()
+
+                # 用于累积工具调用的参数
+                tool_call_accumulator = {}
+
+                # 直接在字节层面判断前缀，JSON 负载原样交给 fastjson 解析
+                for line in response.iter_lines():
+                    if not line.startswith(b'data: '):
+                        continue
+
+                    data = line[6:]  # 去掉 'data: ' 前缀
+                    if data == b'[DONE]':
+                        yield {'type': 'done'}
+                        break
+
+                    try:
+                        chunk = fastjson.loads(data)
+                    except ValueError:
+                        continue
                     parsed = self._parse_chunk(chunk, tool_call_accumulator)
                     if parsed:
                         yield parsed
-                except json.JSONDecodeError:
-                    continue
 
         except requests.exceptions.Timeout:
             logger.error("LLM request timeout")
@@ -138,21 +145,22 @@ class LLMService:
             for tc in delta['tool_calls']:
                 index = tc.get('index', 0)
 
-                if index not in tool_call_accumulator:
-                    tool_call_accumulator[index] = {
+                acc = tool_call_accumulator.get(index)
+                if acc is None:
+                    # 参数片段先收集到列表，完成时一次性拼接
+                    acc = tool_call_accumulator[index] = {
                         'id': '',
                         'name': '',
-                        'arguments': ''
+                        'arguments': []
                     }
 
-                acc = tool_call_accumulator[index]
-
+                function = tc.get('function') or {}
                 if tc.get('id'):
                     acc['id'] = tc['id']
-                if tc.get('function', {}).get('name'):
-                    acc['name'] = tc['function']['name']
-                if tc.get('function', {}).get('arguments'):
-                    acc['arguments'] += tc['function']['arguments']
+                if function.get('name'):
+                    acc['name'] = function['name']
+                if function.get('arguments'):
+                    acc['arguments'].append(function['arguments'])
 
             return None  # 工具调用在 finish 时返回
 
@@ -176,7 +184,7 @@ class LLMService:
                         'tool': {
                             'id': first_tool['id'],
                             'name': first_tool['name'],
-                            'arguments': first_tool['arguments']
+                            'arguments': ''.join(first_tool['arguments'])
                         }
                     }
 
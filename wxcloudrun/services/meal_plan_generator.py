@@ -12,14 +12,30 @@
 """
 import logging
 import random
+from collections import defaultdict
 from datetime import date, timedelta
 from typing import List, Dict, Optional, Tuple, Set
 
 from wxcloudrun import dao
-from wxcloudrun.model import Baby, Food, BabyFoodStatus, SpecialStatus
+from wxcloudrun.model import Baby, Food
+from wxcloudrun.utils import clock, concurrency
 
 logger = logging.getLogger('log')
 
+# 缓存未加载的标记（区别于查询结果为 None）
+_UNSET = object()
+
+
+def _load_testing_food(baby_id: int) -> Optional[Tuple[int, Optional[date]]]:
+    """正在排敏的食材：(食材ID, 排敏结束日期)，没有时返回 None"""
+    status = dao.get_baby_testing_food(baby_id)
+    return (status.food_id, status.testing_end_date) if status else None
+
+
+def _load_has_special_status(baby_id: int) -> bool:
+    """是否有当前生效的特殊状态"""
+    return dao.get_active_special_status(baby_id) is not None
+
 
 class MealPlanGenerator:
     """辅食计划生成器"""
@@ -50,7 +66,7 @@ class MealPlanGenerator:
     TESTING_DAYS = 3
 
     # 蛋白质类别（用于搭配）
-    PROTEIN_CATEGORIES = ['meat', 'dairy', 'seafood']
+    PROTEIN_CATEGORIES = ('meat', 'dairy', 'seafood')
 
     def __init__(self, baby: Baby, user_id: int):
         """
@@ -67,48 +83,77 @@ class MealPlanGenerator:
         # 缓存
         self._safe_foods: Optional[List[Food]] = None
         self._safe_foods_by_category: Optional[Dict[str, List[Food]]] = None
-        self._testing_food: Optional[BabyFoodStatus] = None
-        self._special_status: Optional[SpecialStatus] = None
-        self._all_food_statuses: Optional[List[BabyFoodStatus]] = None
+        self._safe_food_ids_by_category: Optional[Dict[str, Tuple[int, ...]]] = None
+        self._testing_food = _UNSET
+        self._has_special_status: Optional[bool] = None
+        self._known_food_ids: Optional[Set[int]] = None
+        self._all_available_foods: Optional[List[Food]] = None
+        self._existing_meals: Optional[List[Tuple[date, str]]] = None
+
+    def prefetch(self):
+        """
+        并行预取生成计划所需的数据并填充缓存
+
+        未来7天已有计划、全部食材状态、排敏中食材、特殊状态四个查询相互独立，
+        并行执行后总耗时约为单个查询的耗时。查询在独立的数据库会话中执行，
+        看不到当前会话中尚未提交的修改；各任务只返回需要的字段，不把 ORM 实例带出工作线程
+        """
+        if self._existing_meals is not None:
+            return
+
+        baby_id = self.baby.id
+        today = clock.today()
+        existing_meals, food_statuses, testing_food, has_special_status = concurrency.run_parallel(
+            lambda: [
+                (plan.plan_date, plan.meal_type)
+                for plan in dao.get_meal_plans_by_date_range(baby_id, today, today + timedelta(days=6))
+            ],
+            lambda: [(s.food_id, s.status) for s in dao.get_baby_food_statuses(baby_id)],
+            lambda: _load_testing_food(baby_id),
+            lambda: _load_has_special_status(baby_id)
+        )
+
+        self._existing_meals = existing_meals
+        self._known_food_ids = {food_id for food_id, _ in food_statuses}
+        self._testing_food = testing_food
+        self._has_special_status = has_special_status
+        # 安全食材从全部状态中筛选，省去单独查询
+        self._safe_foods = dao.get_foods_by_ids(
+            [food_id for food_id, status in food_statuses if status == 'safe']
+        )
 
     def get_missing_dates(self) -> List[date]:
         """
         获取未来7天中缺少计划的日期列表
 
         Returns:
-            缺少计划的日期列表
+            缺少计划的日期列表（按日期升序）
         """
-        today = date.today()
-        meals = self._get_meals_for_age()
+        today = clock.today()
+        required_meals = frozenset(self._get_meals_for_age())
+        check_dates = [today + timedelta(days=i) for i in range(7)]
 
         # 获取未来7天已有的计划
-        end_date = today + timedelta(days=6)
-        existing_plans = dao.get_meal_plans_by_date_range(self.baby.id, today, end_date)
+        self.prefetch()
 
         # 按日期统计已有计划
         plans_by_date: Dict[date, Set[str]] = {}
-        for plan in existing_plans:
-            if plan.plan_date not in plans_by_date:
-                plans_by_date[plan.plan_date] = set()
-            plans_by_date[plan.plan_date].add(plan.meal_type)
-
-        # 找出缺少计划的日期（该日期缺少任意一餐）
-        missing_dates = []
-        for i in range(7):
-            check_date = today + timedelta(days=i)
-            existing_meals = plans_by_date.get(check_date, set())
-            # 如果该日期缺少任何一餐，则视为需要补全
-            if not existing_meals or not all(meal in existing_meals for meal in meals):
-                missing_dates.append(check_date)
-
-        return missing_dates
+        for plan_date, meal_type in self._existing_meals:
+            plans_by_date.setdefault(plan_date, set()).add(meal_type)
+
+        # 找出缺少计划的日期（该日期缺少任意一餐则视为需要补全）
+        empty = frozenset()
+        return [
+            check_date for check_date in check_dates
+            if not required_meals.issubset(plans_by_date.get(check_date, empty))
+        ]
 
     def generate_and_save(self, target_dates: List[date] = None) -> int:
         """
         生成并保存辅食计划
 
         Args:
-            target_dates: 要生成计划的日期列表，默认为未来7天缺失的日期
+            target_dates: 要生成计划的日期列表（按日期升序），默认为未来7天缺失的日期
 
         Returns:
             成功创建的计划数量
@@ -123,6 +168,7 @@ class MealPlanGenerator:
             return 0
 
         # 生成计划
+        self.prefetch()
         plans = self._generate_plans(target_dates)
 
         logger.info(f"[MealPlanGenerator] 宝宝 {self.baby.id} 生成了 {len(plans)} 个计划")
@@ -141,16 +187,17 @@ class MealPlanGenerator:
         生成指定日期的辅食计划
 
         Args:
-            target_dates: 目标日期列表
+            target_dates: 目标日期列表，须按日期升序（get_missing_dates 的返回值即为升序）
 
         Returns:
             计划数据列表
         """
+        assert all(a < b for a, b in zip(target_dates, target_dates[1:])), 'target_dates 须按日期升序'
         plans = []
         meals = self._get_meals_for_age()
         safe_foods = self._get_safe_foods()
-        special_status = self._get_special_status()
-        testing_status = self._get_testing_food()
+        has_special_status = self._get_has_special_status()
+        testing_food = self._get_testing_food()
 
         logger.info(f"[MealPlanGenerator] 开始生成计划: 宝宝={self.baby.id}, 餐次={meals}, 安全食材数={len(safe_foods)}")
 
@@ -159,12 +206,12 @@ class MealPlanGenerator:
         testing_end_date: Optional[date] = None
         testing_food_added_today = False
 
-        if testing_status:
-            current_testing_food = dao.get_food_by_id(testing_status.food_id)
-            testing_end_date = testing_status.testing_end_date
+        if testing_food:
+            testing_food_id, testing_end_date = testing_food
+            current_testing_food = dao.get_food_by_id(testing_food_id)
             logger.info(f"[MealPlanGenerator] 已有排敏中食材: {current_testing_food.name if current_testing_food else 'None'}, 结束日期: {testing_end_date}")
 
-        for plan_date in sorted(target_dates):
+        for plan_date in target_dates:
             testing_food_added_today = False
 
             # 判断当天是否在排敏期内
@@ -175,7 +222,7 @@ class MealPlanGenerator:
             )
 
             # 判断是否可以添加新食材
-            can_add_new = not special_status and not in_testing_period
+            can_add_new = not has_special_status and not in_testing_period
 
             # 如果排敏期结束且可以添加新食材，选择下一个新食材
             if can_add_new and not in_testing_period:
@@ -186,12 +233,10 @@ class MealPlanGenerator:
                     testing_end_date = plan_date + timedelta(days=self.TESTING_DAYS - 1)
                     in_testing_period = True
                     # 开始排敏
-                    dao.start_food_testing(self.baby.id, next_food.id, self.user_id, self.TESTING_DAYS)
-                    # 刷新所有缓存
-                    self._safe_foods = None
-                    self._safe_foods_by_category = None
-                    self._all_food_statuses = None  # 重要：刷新食材状态缓存
-                    safe_foods = self._get_safe_foods()
+                    status = dao.start_food_testing(self.baby.id, next_food.id, self.user_id, self.TESTING_DAYS)
+                    # 新食材计入已知食材，避免后续日期重复选中；排敏中的食材不是安全食材，安全食材缓存无需刷新
+                    if status:
+                        self._get_known_food_ids().add(next_food.id)
 
             # 检查是否有同类备选食材
             has_same_category_backup = False
@@ -259,33 +304,58 @@ class MealPlanGenerator:
         if self._safe_foods_by_category is not None:
             return self._safe_foods_by_category
 
-        safe_foods = self._get_safe_foods()
-        self._safe_foods_by_category = {}
-
-        for food in safe_foods:
-            if food.category not in self._safe_foods_by_category:
-                self._safe_foods_by_category[food.category] = []
-            self._safe_foods_by_category[food.category].append(food)
-
+        foods_by_category = defaultdict(list)
+        for food in self._get_safe_foods():
+            foods_by_category[food.category].append(food)
+
+        # 转为普通 dict，调用方用 in 判断类别时不会意外插入空列表
+        self._safe_foods_by_category = dict(foods_by_category)
+        # 同时缓存各类别的食材ID元组，组合每餐时直接随机取ID
+        self._safe_food_ids_by_category = {
+            category: tuple(food.id for food in foods)
+            for category, foods in foods_by_category.items()
+        }
         return self._safe_foods_by_category
 
-    def _get_testing_food(self) -> Optional[BabyFoodStatus]:
-        """获取正在排敏的食材状态"""
-        if self._testing_food is None:
-            self._testing_food = dao.get_baby_testing_food(self.baby.id)
-        return self._testing_food
+    def _get_safe_food_ids_by_category(self) -> Dict[str, Tuple[int, ...]]:
+        """获取按类别分组的安全食材ID"""
+        if self._safe_food_ids_by_category is None:
+            self._get_safe_foods_by_category()
+        return self._safe_food_ids_by_category
 
-    def _get_special_status(self) -> Optional[SpecialStatus]:
-        """获取活跃的特殊状态"""
-        if self._special_status is None:
-            self._special_status = dao.get_active_special_status(self.baby.id)
-        return self._special_status
+    def _get_testing_food(self) -> Optional[Tuple[int, Optional[date]]]:
+        """获取正在排敏的食材：(食材ID, 排敏结束日期)"""
+        if self._testing_food is _UNSET:
+            self._testing_food = _load_testing_food(self.baby.id)
+        return self._testing_food
 
-    def _get_all_food_statuses(self) -> List[BabyFoodStatus]:
-        """获取所有食材状态"""
-        if self._all_food_statuses is None:
-            self._all_food_statuses = dao.get_baby_food_statuses(self.baby.id)
-        return self._all_food_statuses
+    def _get_has_special_status(self) -> bool:
+        """是否有活跃的特殊状态"""
+        if self._has_special_status is None:
+            self._has_special_status = _load_has_special_status(self.baby.id)
+        return self._has_special_status
+
+    def _get_known_food_ids(self) -> Set[int]:
+        """获取已有状态（排敏中/安全/过敏等）的食材ID"""
+        if self._known_food_ids is None:
+            self._known_food_ids = {s.food_id for s in dao.get_baby_food_statuses(self.baby.id)}
+        return self._known_food_ids
+
+    def _food_priority(self, food: Food) -> tuple:
+        """食材引入优先级：类别顺序 → 过敏风险 → 排序值"""
+        return (
+            self.FOOD_INTRODUCTION_ORDER.get(food.category, 99),
+            food.allergy_risk,
+            food.sort_order
+        )
+
+    def _get_available_foods(self) -> List[Food]:
+        """获取当前月龄可用的所有食材（已按引入优先级排序）"""
+        if self._all_available_foods is None:
+            self._all_available_foods = sorted(
+                dao.get_all_foods(max_month=self.age_months), key=self._food_priority
+            )
+        return self._all_available_foods
 
     def _select_next_new_food(self) -> Optional[Food]:
         """
@@ -298,40 +368,33 @@ class MealPlanGenerator:
         4. 优先选择低过敏风险的食材
         """
         # 检查特殊状态
-        if self._get_special_status():
+        if self._get_has_special_status():
             logger.info(f"[MealPlanGenerator] 宝宝 {self.baby.id} 有特殊状态，不添加新食材")
             return None
 
         # 获取已有状态的食材ID
-        all_statuses = self._get_all_food_statuses()
-        known_food_ids = {s.food_id for s in all_statuses}
+        known_food_ids = self._get_known_food_ids()
 
         # 获取当前月龄可用的所有食材
-        available_foods = dao.get_all_foods(max_month=self.age_months)
+        available_foods = self._get_available_foods()
         logger.info(f"[MealPlanGenerator] 宝宝 {self.baby.id} 月龄 {self.age_months}, 可用食材数: {len(available_foods)}, 已知食材数: {len(known_food_ids)}")
 
-        # 过滤掉已知的食材
-        candidate_foods = [f for f in available_foods if f.id not in known_food_ids]
-
-        if not candidate_foods:
-            logger.info(f"[MealPlanGenerator] 宝宝 {self.baby.id} 没有可选的新食材")
-            return None
+        # 过滤掉已知的食材（惰性求值，保持优先级顺序）
+        candidate_foods = (f for f in available_foods if f.id not in known_food_ids)
 
         # 特殊处理：如果没有任何安全食材，优先选择高铁米粉
-        safe_foods = self._get_safe_foods()
-        if not safe_foods:
+        if not self._get_safe_foods():
+            candidate_foods = list(candidate_foods)
             iron_rice = next((f for f in candidate_foods if f.name == '高铁米粉'), None)
             if iron_rice:
                 return iron_rice
+            candidate_foods = iter(candidate_foods)
 
-        # 按照引入顺序和过敏风险排序
-        def food_priority(food: Food) -> tuple:
-            category_priority = self.FOOD_INTRODUCTION_ORDER.get(food.category, 99)
-            return (category_priority, food.allergy_risk, food.sort_order)
-
-        candidate_foods.sort(key=food_priority)
-
-        return candidate_foods[0] if candidate_foods else None
+        # 可用食材已按优先级排序，第一个候选即优先级最高的食材，找到即停止扫描
+        next_food = next(candidate_foods, None)
+        if next_food is None:
+            logger.info(f"[MealPlanGenerator] 宝宝 {self.baby.id} 没有可选的新食材")
+        return next_food
 
     def _compose_meal(
         self,
@@ -353,12 +416,17 @@ class MealPlanGenerator:
         Returns:
             (food_ids, new_food_id): 食材ID列表和新食材ID
         """
+        # 按类别分组的安全食材ID
+        ids_by_category = self._get_safe_food_ids_by_category()
+
+        # 还没有安全食材时只能吃新食材（或没有可吃的食材）
+        if not ids_by_category:
+            return ([new_food.id], new_food.id) if new_food else ([], None)
+
         food_ids: List[int] = []
         new_food_id: Optional[int] = None
         used_categories: Set[str] = set()
-
-        # 按类别分组安全食材
-        foods_by_category = self._get_safe_foods_by_category()
+        ids_get = ids_by_category.get
 
         # 1. 如果有新食材，加入
         if new_food:
@@ -367,35 +435,31 @@ class MealPlanGenerator:
             used_categories.add(new_food.category)
 
         # 2. 添加主食（必须）
-        if 'staple' not in used_categories and 'staple' in foods_by_category:
-            staple = self._random_choice(foods_by_category['staple'])
-            food_ids.append(staple.id)
-            used_categories.add('staple')
+        if 'staple' not in used_categories:
+            ids = ids_get('staple')
+            if ids:
+                food_ids.append(self._random_id(ids))
+                used_categories.add('staple')
 
         # 3. 添加蛋白质（如果有）
         for cat in self.PROTEIN_CATEGORIES:
-            if cat not in used_categories and cat in foods_by_category:
-                protein = self._random_choice(foods_by_category[cat])
-                food_ids.append(protein.id)
+            ids = ids_get(cat)
+            if ids and cat not in used_categories:
+                food_ids.append(self._random_id(ids))
                 used_categories.add(cat)
                 break  # 只添加一种蛋白质
 
         # 4. 添加蔬菜或水果（如果有）
-        for cat in ['vegetable', 'fruit']:
-            if cat not in used_categories and cat in foods_by_category:
-                veg_fruit = self._random_choice(foods_by_category[cat])
-                food_ids.append(veg_fruit.id)
+        for cat in ('vegetable', 'fruit'):
+            ids = ids_get(cat)
+            if ids and cat not in used_categories:
+                food_ids.append(self._random_id(ids))
                 used_categories.add(cat)
                 break  # 只添加一种
 
-        # 如果没有任何食材但有新食材，至少返回新食材
-        if not food_ids and new_food:
-            food_ids = [new_food.id]
-            new_food_id = new_food.id
-
         return food_ids, new_food_id
 
     @staticmethod
-    def _random_choice(foods: List[Food]) -> Food:
-        """从食材列表中随机选择一个"""
-        return random.choice(foods) if foods else None
+    def _random_id(food_ids: Tuple[int, ...]) -> int:
+        """从非空的食材ID元组中随机选择一个"""
+        return food_ids[random.randrange(len(food_ids))]
@@ -2,7 +2,7 @@
 工具执行器 - 执行Agent调用的工具
 """
 import logging
-from datetime import datetime, date, timedelta
+from datetime import date, timedelta
 from typing import Dict, Any, Tuple
 
 from wxcloudrun import dao
@@ -166,12 +166,12 @@ class ToolExecutor:
         Returns:
             (success, result): 是否成功和结果数据
         """
-        method = getattr(self, f'_execute_{tool_name}', None)
-        if not method:
+        method = self._HANDLERS.get(tool_name)
+        if method is None:
             return False, {'error': f'未知工具: {tool_name}'}
 
         try:
-            return method(arguments)
+            return method(self, arguments)
         except Exception as e:
             logger.error(f"Tool execution error: {tool_name} - {e}", exc_info=True)
             return False, {'error': str(e)}
@@ -189,7 +189,7 @@ class ToolExecutor:
         # 解析日期
         if start_date_str:
             try:
-                start_date = datetime.strptime(start_date_str, '%Y-%m-%d').date()
+                start_date = date.fromisoformat(start_date_str)
             except ValueError:
                 return False, {'error': '日期格式错误，请使用YYYY-MM-DD格式'}
         else:
@@ -240,24 +240,18 @@ class ToolExecutor:
         # 解析日期
         if meal_date_str:
             try:
-                meal_date = datetime.strptime(meal_date_str, '%Y-%m-%d').date()
+                meal_date = date.fromisoformat(meal_date_str)
             except ValueError:
                 return False, {'error': '日期格式错误，请使用YYYY-MM-DD格式'}
         else:
             meal_date = date.today()
 
-        # 查找食材ID
-        food_ids = []
-        found_foods = []
-        not_found = []
-
-        for name in food_names:
-            food = dao.get_food_by_name(name)
-            if food:
-                food_ids.append(food.id)
-                found_foods.append(food.name)
-            else:
-                not_found.append(name)
+        # 一次性查找所有食材
+        foods_map = dao.get_foods_by_names(food_names)
+        found = [foods_map[name] for name in food_names if name in foods_map]
+        food_ids = [food.id for food in found]
+        found_foods = [food.name for food in found]
+        not_found = [name for name in food_names if name not in foods_map]
 
         if not food_ids:
             return False, {
@@ -279,7 +273,7 @@ class ToolExecutor:
             return False, {'error': '保存失败，请稍后重试'}
 
         # 标记为已完成
-        dao.complete_meal_plan(plan.id)
+        dao.complete_meal_plan(self.baby.id, plan.id)
 
         meal_type_name = MealPlan.MEAL_TYPE_NAMES.get(meal_type, meal_type)
         result = {
@@ -351,3 +345,12 @@ class ToolExecutor:
             'question_type': args.get('question_type', 'other'),
             'use_advanced_model': args.get('use_advanced_model', True)
         }
+
+    # 工具名称 → 处理方法，类定义时构建一次
+    _HANDLERS = {
+        'create_special_status': _execute_create_special_status,
+        'create_meal_record': _execute_create_meal_record,
+        'report_allergy': _execute_report_allergy,
+        'ask_clarification': _execute_ask_clarification,
+        'answer_question': _execute_answer_question,
+    }
@@ -1,39 +1,65 @@
 """
 JWT Token 认证工具
 """
-import os
 import secrets
-from datetime import datetime, timedelta
+import threading
+import time
+from collections import OrderedDict
 from functools import wraps
 
 import jwt
 from flask import request, g
 
+from config import SETTINGS
 from wxcloudrun import dao
 from wxcloudrun.response import make_err_response
 
 # JWT 配置
-JWT_SECRET = os.environ.get('JWT_SECRET', 'yoyo-meal-secret-key-change-in-production')
+JWT_SECRET = SETTINGS.JWT_SECRET
 JWT_ALGORITHM = 'HS256'
 JWT_EXPIRES_DAYS = 7
 
+# 复用同一个 PyJWT 实例，密钥预先编码为 bytes
+_jwt = jwt.PyJWT()
+_JWT_SECRET_BYTES = JWT_SECRET.encode('utf-8')
+_JWT_ALGORITHMS = [JWT_ALGORITHM]
+
+# 已验证 Token 的缓存：token -> (user_id, 过期时刻)
+# 缓存期内跳过 JWT 验签和用户查询；最长 TOKEN_CACHE_TTL 秒，且不超过 Token 自身的有效期
+TOKEN_CACHE_TTL = 300
+TOKEN_CACHE_MAX_SIZE = 4096
+_token_cache: 'OrderedDict[str, tuple]' = OrderedDict()
+_token_cache_lock = threading.Lock()
+
+# check_baby_permission 的 manager 参数未传入时的占位值（None 表示确认不是管理员）
+_UNSET = object()
+
+# 宝宝权限的进程内缓存：(baby_id, user_id) -> (role, 过期时刻)
+# 只缓存有权限的结果，新加入的管理员立即生效；移除管理员后最多 PERMISSION_CACHE_TTL 秒内仍可能通过
+# （本实例上移除时会立即清除）
+PERMISSION_CACHE_TTL = 10
+PERMISSION_CACHE_MAX_SIZE = 4096
+_permission_cache: 'OrderedDict[tuple, tuple]' = OrderedDict()
+_permission_cache_lock = threading.Lock()
+
 
 def generate_token(user_id: int) -> str:
     """生成JWT Token"""
+    now = int(time.time())
     payload = {
         'user_id': user_id,
-        'exp': datetime.utcnow() + timedelta(days=JWT_EXPIRES_DAYS),
-        'iat': datetime.utcnow(),
-        'jti': secrets.token_hex(16)  # 唯一标识符
+        'exp': now + JWT_EXPIRES_DAYS * 86400,
+        'iat': now,
+        'jti': secrets.token_urlsafe(12)  # 唯一标识符(96位随机数，16个字符)
     }
-    token = jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
+    token = _jwt.encode(payload, _JWT_SECRET_BYTES, algorithm=JWT_ALGORITHM)
     return token
 
 
 def decode_token(token: str) -> dict:
     """解码JWT Token"""
     try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+        payload = _jwt.decode(token, _JWT_SECRET_BYTES, algorithms=_JWT_ALGORITHMS)
         return payload
     except jwt.ExpiredSignatureError:
         return None
@@ -41,6 +67,30 @@ def decode_token(token: str) -> dict:
         return None
 
 
+def _get_cached_user_id(token: str):
+    """从缓存获取 Token 对应的用户ID，未命中或已过期返回 None"""
+    with _token_cache_lock:
+        entry = _token_cache.get(token)
+        if entry is None:
+            return None
+        user_id, expires_at = entry
+        if time.monotonic() >= expires_at:
+            del _token_cache[token]
+            return None
+        return user_id
+
+
+def _cache_user_id(token: str, user_id: int, exp: int):
+    """缓存已验证的 Token，超出容量时淘汰最早加入的条目"""
+    ttl = min(TOKEN_CACHE_TTL, exp - time.time()) if exp else TOKEN_CACHE_TTL
+    if ttl <= 0:
+        return
+    with _token_cache_lock:
+        _token_cache[token] = (user_id, time.monotonic() + ttl)
+        while len(_token_cache) > TOKEN_CACHE_MAX_SIZE:
+            _token_cache.popitem(last=False)
+
+
 def get_token_from_header() -> str:
     """从请求头获取Token"""
     auth_header = request.headers.get('Authorization', '')
@@ -58,18 +108,22 @@ def login_required(f):
         if not token:
             return make_err_response('需要登录', code=-1, error_code='AUTH_REQUIRED')
 
-        payload = decode_token(token)
-        if not payload:
-            return make_err_response('Token已过期或无效', code=-1, error_code='TOKEN_EXPIRED')
+        user_id = _get_cached_user_id(token)
+        if user_id is None:
+            payload = decode_token(token)
+            if not payload:
+                return make_err_response('Token已过期或无效', code=-1, error_code='TOKEN_EXPIRED')
+
+            user_id = payload.get('user_id')
+            user = dao.get_user_by_id(user_id)
 
-        user_id = payload.get('user_id')
-        user = dao.get_user_by_id(user_id)
+            if not user:
+                return make_err_response('用户不存在', code=-1, error_code='USER_NOT_FOUND')
 
-        if not user:
-            return make_err_response('用户不存在', code=-1, error_code='USER_NOT_FOUND')
+            _cache_user_id(token, user_id, payload.get('exp'))
+            g.current_user = user
 
-        # 将用户信息存储到 g 对象中
-        g.current_user = user
+        # 将用户ID存储到 g 对象中；命中缓存时用户对象在首次使用时再加载
         g.user_id = user_id
 
         return f(*args, **kwargs)
@@ -78,8 +132,11 @@ def login_required(f):
 
 
 def get_current_user():
-    """获取当前登录用户"""
-    return getattr(g, 'current_user', None)
+    """获取当前登录用户（按需加载，同一请求内只查询一次）"""
+    if 'current_user' not in g:
+        user_id = getattr(g, 'user_id', None)
+        g.current_user = dao.get_user_by_id(user_id) if user_id else None
+    return g.current_user
 
 
 def get_current_user_id() -> int:
@@ -88,17 +145,19 @@ def get_current_user_id() -> int:
 
 
 def generate_invite_code() -> str:
-    """生成邀请码"""
-    return secrets.token_urlsafe(16)[:16]
+    """生成邀请码（16个URL安全字符）"""
+    return secrets.token_urlsafe(12)
 
 
-def check_baby_permission(baby_id: int, user_id: int = None, require_owner: bool = False) -> bool:
+def check_baby_permission(baby_id: int, user_id: int = None, require_owner: bool = False,
+                          manager=_UNSET) -> bool:
     """检查用户是否有权限管理宝宝
 
     Args:
         baby_id: 宝宝ID
         user_id: 用户ID，如果不传则使用当前登录用户
         require_owner: 是否要求必须是创建者
+        manager: 调用方已查询到的管理员关系（可为 None），传入时不再查询
 
     Returns:
         bool: 是否有权限
@@ -109,11 +168,56 @@ def check_baby_permission(baby_id: int, user_id: int = None, require_owner: bool
     if not user_id:
         return False
 
-    manager = dao.get_baby_manager(baby_id, user_id)
+    # 同一请求内相同 (baby_id, user_id) 只查询一次；近期已确认有权限的直接使用缓存的角色
+    managers = g.setdefault('baby_managers', {})
+    key = (baby_id, user_id)
+    if manager is not _UNSET:
+        managers[key] = manager
+    elif key in managers:
+        manager = managers[key]
+    else:
+        role = _get_cached_role(key)
+        if role is not None:
+            return not require_owner or role == 'owner'
+        manager = managers[key] = dao.get_baby_manager(baby_id, user_id)
+
     if not manager:
         return False
 
+    _cache_role(key, manager.role)
+
     if require_owner and manager.role != 'owner':
         return False
 
     return True
+
+
+def _get_cached_role(key: tuple):
+    """获取缓存的管理员角色，未命中或已过期返回 None"""
+    with _permission_cache_lock:
+        entry = _permission_cache.get(key)
+        if entry is None:
+            return None
+        role, expires_at = entry
+        if time.monotonic() >= expires_at:
+            del _permission_cache[key]
+            return None
+        return role
+
+
+def _cache_role(key: tuple, role: str):
+    """缓存管理员角色，超出容量时淘汰最早加入的条目"""
+    with _permission_cache_lock:
+        _permission_cache[key] = (role, time.monotonic() + PERMISSION_CACHE_TTL)
+        while len(_permission_cache) > PERMISSION_CACHE_MAX_SIZE:
+            _permission_cache.popitem(last=False)
+
+
+def invalidate_baby_permission(baby_id: int, user_id: int = None):
+    """清除宝宝权限缓存（移除管理员、删除宝宝后调用）；不传 user_id 时清除该宝宝的所有用户"""
+    with _permission_cache_lock:
+        if user_id is not None:
+            _permission_cache.pop((baby_id, user_id), None)
+            return
+        for key in [key for key in _permission_cache if key[0] == baby_id]:
+            del _permission_cache[key]
@@ -0,0 +1,45 @@
+"""
+请求时钟 - 同一请求内使用同一个当前时间
+"""
+from datetime import datetime, date
+from typing import Optional
+
+from flask import g, has_app_context
+
+
+def start_request(now: Optional[datetime] = None):
+    """记录请求开始时刻（注册为 before_request 钩子）
+
+    后台线程中的应用上下文可传入所属请求的时刻，保持同一时钟
+    """
+    g.now = now or datetime.now()
+    g.today = g.now.date()
+    g.today_ym = g.today.year * 12 + g.today.month
+
+
+def now() -> datetime:
+    """当前时间；请求内固定为请求开始时刻，请求外实时获取"""
+    if has_app_context():
+        value = g.get('now')
+        if value is not None:
+            return value
+    return datetime.now()
+
+
+def today() -> date:
+    """当前日期；请求内固定为请求开始日期，避免跨零点时前后不一致"""
+    if has_app_context():
+        value = g.get('today')
+        if value is not None:
+            return value
+    return date.today()
+
+
+def today_ym() -> int:
+    """当前年月序号（年*12+月），用于月龄计算"""
+    if has_app_context():
+        value = g.get('today_ym')
+        if value is not None:
+            return value
+    current = date.today()
+    return current.year * 12 + current.month
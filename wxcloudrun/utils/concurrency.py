@@ -0,0 +1,58 @@
+"""
+并发工具 - 在线程池中并行执行相互独立的 IO 密集任务
+"""
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, List
+
+from flask import current_app
+
+from wxcloudrun.utils import clock
+
+logger = logging.getLogger('log')
+
+# 进程内共享的线程池，限制单个实例同时占用的额外数据库连接数
+_executor = ThreadPoolExecutor(max_workers=6, thread_name_prefix='parallel')
+
+# 后台任务线程池，与请求内并行查询的线程池分开，避免后台任务占满线程时请求被阻塞
+_background_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='background')
+
+
+def _run_in_app_context(app, now, func: Callable[[], Any]) -> Any:
+    """在新的应用上下文中执行任务，任务使用线程自己的数据库会话"""
+    with app.app_context():
+        clock.start_request(now)
+        return func()
+
+
+def run_parallel(*funcs: Callable[[], Any]) -> List[Any]:
+    """
+    并行执行多个无参函数，按传入顺序返回结果
+
+    每个任务运行在独立的应用上下文和数据库会话中，上下文结束时会话即被关闭，
+    因此任务应返回普通数据，而不是需要延迟加载的 ORM 实例。任一任务抛出的异常会在此处重新抛出。
+    """
+    app = current_app._get_current_object()
+    now = clock.now()
+    futures = [_executor.submit(_run_in_app_context, app, now, func) for func in funcs]
+    return [future.result() for future in futures]
+
+
+def _run_background(app, now, func: Callable[..., Any], args: tuple):
+    """执行后台任务，异常只记录日志"""
+    try:
+        return _run_in_app_context(app, now, lambda: func(*args))
+    except Exception as e:
+        logger.error(f"background task {getattr(func, '__name__', func)} error: {e}", exc_info=True)
+        return None
+
+
+def submit_background(func: Callable[..., Any], *args) -> Future:
+    """
+    提交后台任务后立即返回，不等待执行结果
+
+    任务在独立的应用上下文和数据库会话中执行，参数应传 ID 等普通数据，
+    不要传当前请求会话中的 ORM 实例
+    """
+    app = current_app._get_current_object()
+    return _background_executor.submit(_run_background, app, clock.now(), func, args)
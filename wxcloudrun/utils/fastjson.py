@@ -0,0 +1,43 @@
+"""
+JSON 序列化工具 - 优先使用 orjson（C实现，原生支持 date/datetime），未安装时回退到标准库 json
+"""
+import json
+from dataclasses import asdict, is_dataclass
+from datetime import date, datetime
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(obj):
+    """序列化 JSON 原生类型以外的对象"""
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    # orjson 原生支持数据类，标准库 json 需转换为字典
+    if is_dataclass(obj):
+        return asdict(obj)
+    # 模型实例可直接放入响应数据，序列化时调用其 to_dict
+    to_dict = getattr(obj, 'to_dict', None)
+    if to_dict is not None:
+        return to_dict()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+if orjson is not None:
+    _OPTIONS = orjson.OPT_NON_STR_KEYS
+
+    def dumps(obj) -> bytes:
+        """序列化为 UTF-8 编码的 JSON bytes"""
+        return orjson.dumps(obj, default=_default, option=_OPTIONS)
+
+    loads = orjson.loads
+else:
+    def dumps(obj) -> bytes:
+        """序列化为 UTF-8 编码的 JSON bytes"""
+        return json.dumps(
+            obj, ensure_ascii=False, separators=(',', ':'), default=_default
+        ).encode('utf-8')
+
+    loads = json.loads
@@ -0,0 +1,160 @@
+"""
+Redis 客户端 - 配置 REDIS_URL 后启用，未配置时调用方回退到进程内实现
+"""
+import logging
+import threading
+
+from config import SETTINGS
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+logger = logging.getLogger('log')
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_redis():
+    """获取共享连接池的Redis客户端；未配置 REDIS_URL 或未安装 redis 时返回 None"""
+    global _client
+    if _client is not None:
+        return _client
+    if not SETTINGS.REDIS_URL:
+        return None
+    if redis is None:
+        logger.error("REDIS_URL is set but the redis package is not installed")
+        return None
+
+    with _client_lock:
+        if _client is None:
+            _client = redis.Redis.from_url(
+                SETTINGS.REDIS_URL,
+                socket_timeout=2,
+                socket_connect_timeout=2,
+                health_check_interval=30
+            )
+    return _client
+
+
+# ==========================================
+# 宝宝数据版本号
+# 宝宝相关数据每次提交修改后递增版本号，缓存键中带上版本号，
+# 数据变化后旧缓存自然失效，无需逐个删除
+# ==========================================
+
+BABY_VERSION_KEY = 'baby:{}:ver'
+BABY_VERSION_TTL = 86400  # 版本号保留时间，需大于依赖它的缓存的TTL
+
+
+def get_baby_version(baby_id: int):
+    """获取宝宝数据版本号；未启用 Redis 或读取失败时返回 None"""
+    client = get_redis()
+    if client is None:
+        return None
+    try:
+        value = client.get(BABY_VERSION_KEY.format(baby_id))
+    except redis.RedisError as e:
+        logger.error(f"get_baby_version error: {e}")
+        return None
+    return int(value) if value else 0
+
+
+def bump_baby_versions(baby_ids):
+    """递增宝宝数据版本号"""
+    client = get_redis()
+    if client is None or not baby_ids:
+        return
+    try:
+        pipe = client.pipeline(transaction=False)
+        for baby_id in baby_ids:
+            key = BABY_VERSION_KEY.format(baby_id)
+            pipe.incr(key)
+            pipe.expire(key, BABY_VERSION_TTL)
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.error(f"bump_baby_versions error: {e}")
+
+
+# ==========================================
+# 辅食计划补全标记
+# 某宝宝在某个数据版本下已补全到当天起7天的计划时记录标记，
+# 登录/auth_me 时据此跳过计划生成；宝宝数据变化或日期变化后标记自然失效
+# ==========================================
+
+MEAL_PLANS_FILLED_KEY = 'baby:{}:plans_filled:{}:{}'
+MEAL_PLANS_FILLED_TTL = 86400
+
+
+def _meal_plans_filled_key(client, baby_id: int, day) -> str:
+    value = client.get(BABY_VERSION_KEY.format(baby_id))
+    return MEAL_PLANS_FILLED_KEY.format(baby_id, int(value) if value else 0, day.isoformat())
+
+
+def filter_unfilled_babies(baby_ids, day):
+    """返回需要补全计划的宝宝ID；未启用 Redis 或读取失败时原样返回"""
+    client = get_redis()
+    if client is None or not baby_ids:
+        return list(baby_ids)
+    try:
+        versions = client.mget([BABY_VERSION_KEY.format(baby_id) for baby_id in baby_ids])
+        keys = [
+            MEAL_PLANS_FILLED_KEY.format(baby_id, int(version) if version else 0, day.isoformat())
+            for baby_id, version in zip(baby_ids, versions)
+        ]
+        filled = client.mget(keys)
+    except redis.RedisError as e:
+        logger.error(f"filter_unfilled_babies error: {e}")
+        return list(baby_ids)
+    return [baby_id for baby_id, flag in zip(baby_ids, filled) if flag is None]
+
+
+def mark_meal_plans_filled(baby_id: int, day):
+    """记录宝宝在当前数据版本下已补全计划（需在计划写入提交之后调用）"""
+    client = get_redis()
+    if client is None:
+        return
+    try:
+        client.setex(_meal_plans_filled_key(client, baby_id, day), MEAL_PLANS_FILLED_TTL, 1)
+    except redis.RedisError as e:
+        logger.error(f"mark_meal_plans_filled error: {e}")
+
+
+# ==========================================
+# 宝宝数据响应缓存
+# 缓存按宝宝数据版本序列化好的响应体，宝宝数据提交修改后版本号递增，旧缓存自然失效；
+# TTL 与食材缓存一致，食材库变化（不影响宝宝版本号）最多延迟同样时间生效
+# ==========================================
+
+BABY_PAYLOAD_KEY = 'baby:{}:payload:{}:{}'
+BABY_PAYLOAD_TTL = 300
+
+
+def baby_payload_key(baby_id: int, name: str):
+    """生成宝宝当前数据版本下的响应缓存键；未启用 Redis 或读取失败时返回 None
+
+    name 需包含响应依赖的所有参数（如查询日期、当天日期）
+    """
+    version = get_baby_version(baby_id)
+    if version is None:
+        return None
+    return BABY_PAYLOAD_KEY.format(baby_id, version, name)
+
+
+def get_baby_payload(key: str):
+    """读取缓存的响应体，未命中或读取失败时返回 None"""
+    try:
+        return get_redis().get(key)
+    except redis.RedisError as e:
+        logger.error(f"get_baby_payload error: {e}")
+        return None
+
+
+def set_baby_payload(key: str, body: bytes):
+    """缓存响应体"""
+    try:
+        get_redis().setex(key, BABY_PAYLOAD_TTL, body)
+    except redis.RedisError as e:
+        logger.error(f"set_baby_payload error: {e}")
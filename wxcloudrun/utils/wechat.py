@@ -1,18 +1,51 @@
 """
 微信小程序 API 封装
 """
-import os
 import logging
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from config import SETTINGS
 
 logger = logging.getLogger('log')
 
 # 微信小程序配置
-APPID = os.environ.get('WX_APPID', '')
-APP_SECRET = os.environ.get('WX_APP_SECRET', '')
+APPID = SETTINGS.WX_APPID
+APP_SECRET = SETTINGS.WX_APP_SECRET
+
+
+def _build_session() -> requests.Session:
+    """创建进程内共享的 HTTP 会话，复用到微信 API 的 TCP/TLS 连接
+
+    连接失败等瞬时错误最多重试2次（默认不重试 POST 等非幂等请求）
+    """
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=50,
+        max_retries=Retry(total=2, backoff_factor=0.1)
+    ))
+    return session
+
+
+_session = _build_session()
+
+# 请求超时（连接超时, 读取超时），连接阶段卡住时尽快失败并交给重试
+REQUEST_TIMEOUT = (3.05, 10)
 
+# access_token 进程内缓存：微信下发的 token 有效期为7200秒，且接口有每日调用次数限制
+ACCESS_TOKEN_REFRESH_AHEAD = 300  # 提前5分钟刷新
+_token_cache = {'token': None, 'expires_at': 0.0}
+_token_lock = threading.Lock()
 
-def code2session(code: str) -> dict:
+# access_token 失效/过期的错误码（其他实例重新获取 token 后，本实例缓存的旧 token 会失效）
+_INVALID_TOKEN_ERRCODES = (40001, 42001)
+
+
+def _real_code2session(code: str) -> dict:
     """使用登录凭证code换取session_key和openid
 
     微信官方接口：https://developers.weixin.qq.com/miniprogram/dev/OpenApiDoc/user-login/code2Session.html
@@ -28,14 +61,6 @@ def code2session(code: str) -> dict:
             - errcode: 错误码（成功时不存在）
             - errmsg: 错误信息（成功时不存在）
     """
-    if not APPID or not APP_SECRET:
-        logger.warning("微信小程序配置缺失，使用模拟模式")
-        # 开发环境模拟返回
-        return {
-            'openid': f'mock_openid_{code[:8]}',
-            'session_key': 'mock_session_key'
-        }
-
     url = 'https://api.weixin.qq.com/sns/jscode2session'
     params = {
         'appid': APPID,
@@ -45,7 +70,7 @@ def code2session(code: str) -> dict:
     }
 
     try:
-        response = requests.get(url, params=params, timeout=10)
+        response = _session.get(url, params=params, timeout=REQUEST_TIMEOUT)
         result = response.json()
 
         if 'errcode' in result and result['errcode'] != 0:
@@ -58,10 +83,43 @@ def code2session(code: str) -> dict:
         return None
 
 
+def _mock_code2session(code: str) -> dict:
+    """开发环境（未配置小程序 AppID/AppSecret）模拟 code2session 返回"""
+    logger.warning("微信小程序配置缺失，使用模拟模式")
+    return {
+        'openid': f'mock_openid_{code[:8]}',
+        'session_key': 'mock_session_key'
+    }
+
+
+# 是否使用模拟模式在导入时确定一次，之后直接调用对应实现
+code2session = _real_code2session if APPID and APP_SECRET else _mock_code2session
+
+
+def invalidate_access_token(token: str):
+    """丢弃缓存的 access_token，下次调用 get_access_token 时重新获取
+
+    只有缓存中仍是该 token 时才丢弃，避免并发请求把其他线程刚刷新的 token 也作废
+    """
+    with _token_lock:
+        if _token_cache['token'] == token:
+            _token_cache['token'] = None
+            _token_cache['expires_at'] = 0.0
+
+
+def _get_cached_access_token():
+    """读取未临近过期的缓存 token，没有则返回 None"""
+    token = _token_cache['token']
+    if token and time.time() < _token_cache['expires_at'] - ACCESS_TOKEN_REFRESH_AHEAD:
+        return token
+    return None
+
+
 def get_access_token() -> str:
     """获取小程序全局唯一后台接口调用凭据（access_token）
 
-    注意：此接口有调用频率限制，生产环境应该缓存token
+    token 在进程内缓存至过期前5分钟，期间不再请求微信接口。
+    缓存失效时加锁后再检查一次，并发请求只有一个线程实际发起刷新，其余线程等待后直接读取缓存
 
     Returns:
         str: access_token，失败返回None
@@ -70,6 +128,19 @@ def get_access_token() -> str:
         logger.warning("微信小程序配置缺失")
         return None
 
+    token = _get_cached_access_token()
+    if token:
+        return token
+
+    with _token_lock:
+        token = _get_cached_access_token()
+        if token:
+            return token
+        return _fetch_access_token()
+
+
+def _fetch_access_token() -> str:
+    """请求微信接口获取 access_token 并写入缓存，调用方需持有 _token_lock"""
     url = 'https://api.weixin.qq.com/cgi-bin/token'
     params = {
         'grant_type': 'client_credential',
@@ -78,14 +149,18 @@ def get_access_token() -> str:
     }
 
     try:
-        response = requests.get(url, params=params, timeout=10)
+        response = _session.get(url, params=params, timeout=REQUEST_TIMEOUT)
         result = response.json()
 
         if 'errcode' in result and result['errcode'] != 0:
             logger.error(f"获取access_token失败: {result}")
             return None
 
-        return result.get('access_token')
+        token = result.get('access_token')
+        if token:
+            _token_cache['token'] = token
+            _token_cache['expires_at'] = time.time() + result.get('expires_in', 7200)
+        return token
     except Exception as e:
         logger.error(f"获取access_token请求异常: {e}")
         return None
@@ -101,11 +176,6 @@ def generate_scheme(path: str = None, query: str = None) -> str:
     Returns:
         str: URL Scheme，失败返回None
     """
-    access_token = get_access_token()
-    if not access_token:
-        return None
-
-    url = f'https://api.weixin.qq.com/wxa/generatescheme?access_token={access_token}'
     data = {
         'jump_wxa': {
             'path': path or '',
@@ -116,8 +186,20 @@ def generate_scheme(path: str = None, query: str = None) -> str:
     }
 
     try:
-        response = requests.post(url, json=data, timeout=10)
-        result = response.json()
+        result = None
+        for _ in range(2):
+            access_token = get_access_token()
+            if not access_token:
+                return None
+
+            url = f'https://api.weixin.qq.com/wxa/generatescheme?access_token={access_token}'
+            response = _session.post(url, json=data, timeout=REQUEST_TIMEOUT)
+            result = response.json()
+
+            # 缓存的 token 已失效时丢弃并重试一次
+            if result.get('errcode') not in _INVALID_TOKEN_ERRCODES:
+                break
+            invalidate_access_token(access_token)
 
         if result.get('errcode', 0) != 0:
             logger.error(f"生成URL Scheme失败: {result}")
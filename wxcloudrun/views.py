@@ -2,23 +2,76 @@
 YoYo辅食管理 - API路由
 所有API接口定义
 """
+from collections import Counter
+from dataclasses import dataclass
 from datetime import datetime, date, timedelta
+from typing import List, Optional, Tuple
 from flask import render_template, request
 
 from run import app
 from wxcloudrun import dao
-from wxcloudrun.model import Food
-from wxcloudrun.response import make_succ_response, make_err_response
+from wxcloudrun.model import Baby, Food, BabyFoodStatus, MealPlan, SpecialStatus
+from wxcloudrun.response import (
+    make_succ_response, make_succ_body, make_conditional_succ_response, make_conditional_body_response,
+    make_err_response
+)
 from wxcloudrun.utils.auth import (
     generate_token, login_required, get_current_user, get_current_user_id,
-    check_baby_permission, generate_invite_code
+    check_baby_permission, invalidate_baby_permission, generate_invite_code
 )
 from wxcloudrun.utils.wechat import code2session
 from wxcloudrun.services.meal_plan_generator import MealPlanGenerator
+from wxcloudrun.utils import clock, concurrency, redis_client
 import logging
 
 logger = logging.getLogger('log')
 
+# 月龄 -> 应显示的餐次：6个月及以下1顿，7-8个月2顿，9个月及以上3顿
+# 按月龄下标查表，9个月以上统一取最后一项
+_MEALS_BY_MONTH = tuple(
+    ('lunch',) if month <= 6 else ('lunch', 'dinner') if month <= 8 else ('breakfast', 'lunch', 'dinner')
+    for month in range(10)
+)
+
+# 请求参数中枚举值的校验集合（模型中的元组用于定义数据库 Enum 列）
+_VALID_MEAL_TYPES = frozenset(MealPlan.MEAL_TYPES)
+_VALID_FOOD_STATUSES = frozenset(BabyFoodStatus.STATUSES)
+_VALID_STATUS_TYPES = frozenset(SpecialStatus.STATUS_TYPES)
+
+# 食材ID上限（INT UNSIGNED 列）与特殊状态持续天数上限
+_MAX_FOOD_ID = 2 ** 32 - 1
+_MAX_STATUS_DAYS = 365
+
+
+def _parse_food_id(value) -> Optional[int]:
+    """解析请求中的食材ID，接受整数或纯数字字符串；类型不对或超出范围时返回 None
+
+    用 type() 判断：bool 是 int 的子类，isinstance 会放过 true/false
+    """
+    if type(value) is str and value.isascii() and value.isdigit():
+        value = int(value)
+    if type(value) is not int or not 0 < value <= _MAX_FOOD_ID:
+        return None
+    return value
+
+
+# 辅食计划响应中的食材条目：每个计划的每个食材一条，用 __slots__ 数据类代替字典，
+# orjson 直接序列化为 JSON 对象
+@dataclass
+class _PlanFood:
+    __slots__ = ('id', 'name', 'is_new')
+    id: int
+    name: str
+    is_new: bool
+
+
+@dataclass
+class _PlanNewFood:
+    __slots__ = ('id', 'name', 'testing_day')
+    id: int
+    name: str
+    testing_day: int
+
 
 # ==========================================
 # 首页
@@ -63,7 +116,8 @@ def auth_login():
     openid = wx_result['openid']
     session_key = wx_result.get('session_key')
 
-    # 查找或创建用户
+    # 查找或创建用户。新用户只 flush 拿到ID，用户信息、session_key 和 token
+    # 由请求结束时的 commit_session 一次提交，提交前后都不会重新加载用户
     user = dao.get_user_by_openid(openid)
     is_new_user = False
 
@@ -71,10 +125,11 @@ def auth_login():
         # 创建新用户
         nickname = params.get('nickname')
         avatar_url = params.get('avatar_url')
-        user = dao.create_user(openid, nickname, avatar_url)
-        is_new_user = True
-        if not user:
+        try:
+            user = dao.create_user(openid, nickname, avatar_url, commit=False)
+        except dao.TransactionFailed:
             return make_err_response('创建用户失败', error_code='CREATE_USER_FAILED')
+        is_new_user = True
     else:
         # 更新用户信息
         if params.get('nickname'):
@@ -89,36 +144,25 @@ def auth_login():
     token = generate_token(user.id)
     user.token = token
     user.token_expires_at = datetime.now() + timedelta(days=7)
-    dao.update_user(user)
 
     # 获取用户的宝宝列表
     babies = dao.get_babies_by_user(user.id)
     babies_data = []
+    managers = dao.get_baby_managers_for_user(user.id, [baby.id for baby in babies])
     for baby in babies:
-        manager = dao.get_baby_manager(baby.id, user.id)
+        manager = managers.get(baby.id)
         babies_data.append({
             'id': baby.id,
             'name': baby.name,
             'gender': baby.gender,
-            'birthday': baby.birthday.isoformat() if baby.birthday else None,
+            'birthday': baby.birthday,
             'age_months': baby.get_age_months(),
             'role': manager.role if manager else 'unknown'
         })
 
-    # 为每个宝宝补全未来7天的辅食计划
+    # 后台为每个宝宝补全未来7天的辅食计划，不阻塞登录
     logger.info(f"[Login] 用户 {user.id} 有 {len(babies)} 个宝宝")
-    for baby in babies:
-        try:
-            logger.info(f"[Login] 为宝宝 {baby.id} ({baby.name}) 生成计划, 月龄: {baby.get_age_months()}")
-            generator = MealPlanGenerator(baby, user.id)
-            missing_dates = generator.get_missing_dates()
-            if missing_dates:
-                count = generator.generate_and_save(missing_dates)
-                logger.info(f"[Login] 为宝宝 {baby.id} 补全了 {count} 个辅食计划")
-            else:
-                logger.info(f"[Login] 宝宝 {baby.id} 不需要补全计划")
-        except Exception as e:
-            logger.error(f"[Login] 生成辅食计划失败: {e}", exc_info=True)
+    _schedule_meal_plan_fill(user.id, babies, 'Login')
 
     return make_succ_response({
         'token': token,
@@ -134,6 +178,38 @@ def auth_login():
     })
 
 
+def _fill_meal_plans(user_id: int, baby_id: int, source: str):
+    """为宝宝补全未来7天的辅食计划（在后台线程中执行，按ID重新查询宝宝）"""
+    try:
+        baby = dao.get_baby_by_id(baby_id)
+        if not baby:
+            return
+        logger.info(f"[{source}] 为宝宝 {baby.id} ({baby.name}) 生成计划, 月龄: {baby.get_age_months()}")
+        generator = MealPlanGenerator(baby, user_id)
+        missing_dates = generator.get_missing_dates()
+        if missing_dates:
+            count = generator.generate_and_save(missing_dates)
+            logger.info(f"[{source}] 为宝宝 {baby.id} 补全了 {count} 个辅食计划")
+            # 没有生成任何计划（无可用食材或保存失败）时不记标记，下次登录再尝试
+            if not count:
+                return
+        else:
+            logger.info(f"[{source}] 宝宝 {baby.id} 不需要补全计划")
+        redis_client.mark_meal_plans_filled(baby_id, clock.today())
+    except Exception as e:
+        logger.error(f"[{source}] 生成辅食计划失败: {e}", exc_info=True)
+
+
+def _schedule_meal_plan_fill(user_id: int, babies: List[Baby], source: str):
+    """每个宝宝提交一个后台任务，各宝宝的计划生成相互独立，可并行执行
+
+    启用 Redis 时跳过当前数据版本下今天已补全过的宝宝
+    """
+    baby_ids = redis_client.filter_unfilled_babies([baby.id for baby in babies], clock.today())
+    for baby_id in baby_ids:
+        concurrency.submit_background(_fill_meal_plans, user_id, baby_id, source)
+
+
 @app.route('/api/auth/me', methods=['GET'])
 @login_required
 def auth_me():
@@ -143,30 +219,23 @@ def auth_me():
     # 获取用户的宝宝列表
     babies = dao.get_babies_by_user(user.id)
     babies_data = []
+    managers = dao.get_baby_managers_for_user(user.id, [baby.id for baby in babies])
     for baby in babies:
-        manager = dao.get_baby_manager(baby.id, user.id)
+        manager = managers.get(baby.id)
         babies_data.append({
             'id': baby.id,
             'name': baby.name,
             'gender': baby.gender,
-            'birthday': baby.birthday.isoformat() if baby.birthday else None,
+            'birthday': baby.birthday,
             'age_months': baby.get_age_months(),
             'role': manager.role if manager else 'unknown'
         })
 
-    # 为每个宝宝补全未来7天的辅食计划
-    for baby in babies:
-        try:
-            generator = MealPlanGenerator(baby, user.id)
-            missing_dates = generator.get_missing_dates()
-            if missing_dates:
-                count = generator.generate_and_save(missing_dates)
-                logger.info(f"[auth_me] 为宝宝 {baby.id} 补全了 {count} 个辅食计划")
-        except Exception as e:
-            logger.error(f"[auth_me] 生成辅食计划失败: {e}", exc_info=True)
+    # 后台为每个宝宝补全未来7天的辅食计划
+    _schedule_meal_plan_fill(user.id, babies, 'auth_me')
 
     return make_succ_response({
-        'user': user.to_dict(),
+        'user': user,
         'babies': babies_data,
         'current_baby_id': user.current_baby_id
     })
@@ -181,23 +250,25 @@ def auth_me():
 def get_babies():
     """获取宝宝列表"""
     user_id = get_current_user_id()
+    current_baby_id = get_current_user().current_baby_id
     babies = dao.get_babies_by_user(user_id)
 
+    baby_ids = [baby.id for baby in babies]
+    managers = dao.get_baby_managers_for_user(user_id, baby_ids)
+    special_status_baby_ids = dao.get_baby_ids_with_active_special_status(baby_ids)
+
     result = []
     for baby in babies:
-        manager = dao.get_baby_manager(baby.id, user_id)
-        special_status = dao.get_active_special_status(baby.id)
-
-        result.append({
-            **baby.to_dict(),
+        manager = managers.get(baby.id)
+        result.append(baby.to_dict(extra={
             'role': manager.role if manager else 'unknown',
-            'is_current': baby.id == get_current_user().current_baby_id,
-            'has_special_status': special_status is not None
-        })
+            'is_current': baby.id == current_baby_id,
+            'has_special_status': baby.id in special_status_baby_ids
+        }))
 
     return make_succ_response({
         'babies': result,
-        'current_baby_id': get_current_user().current_baby_id
+        'current_baby_id': current_baby_id
     })
 
 
@@ -227,8 +298,8 @@ def create_baby():
         return make_err_response('请输入出生日期', error_code='INVALID_PARAMS')
 
     try:
-        birthday = datetime.strptime(birthday_str, '%Y-%m-%d').date()
-    except ValueError:
+        birthday = date.fromisoformat(birthday_str)
+    except (TypeError, ValueError):
         return make_err_response('出生日期格式错误', error_code='INVALID_PARAMS')
 
     # 校验月龄（必须在6-36月龄之间）
@@ -250,27 +321,25 @@ def create_baby():
     else:
         gender = 0
 
-    # 创建宝宝
-    baby = dao.create_baby(
-        name=name,
-        birthday=birthday,
-        gender=gender,
-        created_by=user_id,
-        avatar=params.get('avatar'),
-        allergy_notes=params.get('allergy_notes'),
-        food_preferences=params.get('food_preferences')
-    )
-
-    if not baby:
+    # 创建宝宝并设置为当前宝宝（同一事务提交）
+    try:
+        with dao.transaction():
+            baby = dao.create_baby(
+                name=name,
+                birthday=birthday,
+                gender=gender,
+                created_by=user_id,
+                avatar=params.get('avatar'),
+                allergy_notes=params.get('allergy_notes'),
+                food_preferences=params.get('food_preferences'),
+                commit=False
+            )
+            get_current_user().current_baby_id = baby.id
+    except dao.TransactionFailed:
         return make_err_response('创建宝宝失败', error_code='CREATE_BABY_FAILED')
 
-    # 设置为当前宝宝
-    user = get_current_user()
-    user.current_baby_id = baby.id
-    dao.update_user(user)
-
     return make_succ_response({
-        'baby': baby.to_dict(),
+        'baby': baby,
         'message': '创建成功'
     })
 
@@ -300,20 +369,19 @@ def get_baby(baby_id):
             testing_food_info = {
                 'food_id': food.id,
                 'food_name': food.name,
-                'start_date': testing_food.testing_start_date.isoformat() if testing_food.testing_start_date else None,
-                'end_date': testing_food.testing_end_date.isoformat() if testing_food.testing_end_date else None,
+                'start_date': testing_food.testing_start_date,
+                'end_date': testing_food.testing_end_date,
                 'days_remaining': testing_food.get_testing_days_remaining()
             }
 
     # 获取管理员信息
     manager = dao.get_baby_manager(baby_id, user_id)
 
-    return make_succ_response({
-        **baby.to_dict(),
+    return make_succ_response(baby.to_dict(extra={
         'role': manager.role if manager else 'unknown',
-        'special_status': special_status.to_dict() if special_status else None,
+        'special_status': special_status,
         'testing_food': testing_food_info
-    })
+    }))
 
 
 @app.route('/api/babies/<int:baby_id>', methods=['PUT'])
@@ -331,36 +399,34 @@ def update_baby(baby_id):
 
     params = request.get_json() or {}
 
-    # 更新字段
-    if 'name' in params:
-        baby.name = params['name']
-    if 'avatar' in params:
-        baby.avatar = params['avatar']
+    # 先解析并校验全部字段，都通过后再修改宝宝对象，校验失败时不留下部分修改
+    updates = {
+        field: params[field]
+        for field in ('name', 'avatar', 'allergy_notes', 'food_preferences')
+        if field in params
+    }
     if 'gender' in params:
         gender_param = params['gender']
         if gender_param == 'male':
-            baby.gender = 1
+            updates['gender'] = 1
         elif gender_param == 'female':
-            baby.gender = 2
+            updates['gender'] = 2
         elif isinstance(gender_param, int):
-            baby.gender = gender_param
+            updates['gender'] = gender_param
         else:
-            baby.gender = 0
+            updates['gender'] = 0
     if 'birthday' in params:
         try:
-            baby.birthday = datetime.strptime(params['birthday'], '%Y-%m-%d').date()
-        except ValueError:
+            updates['birthday'] = date.fromisoformat(params['birthday'])
+        except (TypeError, ValueError):
             return make_err_response('出生日期格式错误', error_code='INVALID_PARAMS')
-    if 'allergy_notes' in params:
-        baby.allergy_notes = params['allergy_notes']
-    if 'food_preferences' in params:
-        baby.food_preferences = params['food_preferences']
 
-    if not dao.update_baby(baby):
-        return make_err_response('更新失败', error_code='UPDATE_FAILED')
+    # 更新字段
+    for field, value in updates.items():
+        setattr(baby, field, value)
 
     return make_succ_response({
-        'baby': baby.to_dict(),
+        'baby': baby,
         'message': '更新成功'
     })
 
@@ -376,6 +442,7 @@ def delete_baby(baby_id):
 
     if not dao.delete_baby(baby_id):
         return make_err_response('删除失败', error_code='DELETE_FAILED')
+    invalidate_baby_permission(baby_id)
 
     # 如果删除的是当前宝宝，清除current_baby_id
     user = get_current_user()
@@ -385,7 +452,6 @@ def delete_baby(baby_id):
         babies = dao.get_babies_by_user(user_id)
         if babies:
             user.current_baby_id = babies[0].id
-        dao.update_user(user)
 
     return make_succ_response({'message': '删除成功'})
 
@@ -401,7 +467,6 @@ def switch_baby(baby_id):
 
     user = get_current_user()
     user.current_baby_id = baby_id
-    dao.update_user(user)
 
     return make_succ_response({'message': '切换成功', 'current_baby_id': baby_id})
 
@@ -443,7 +508,7 @@ def create_invite(baby_id):
     return make_succ_response({
         'invite_code': code,
         'invite_url': f'/pages/invite/accept?code={code}',
-        'expires_at': invitation.expires_at.isoformat()
+        'expires_at': invitation.expires_at
     })
 
 
@@ -475,25 +540,28 @@ def accept_invite():
     if existing:
         return make_err_response('您已经是该宝宝的管理员', error_code='ALREADY_MANAGER')
 
-    # 添加为管理员
-    manager = dao.add_baby_manager(
-        baby_id=invitation.baby_id,
-        user_id=user_id,
-        invited_by=invitation.inviter_id
-    )
-
-    if not manager:
+    # 使用邀请并添加为管理员（同一事务提交，添加失败时邀请次数一并回滚）
+    try:
+        with dao.transaction():
+            # 原子扣减次数，并发时只有可用次数内的请求能成功
+            if not dao.use_invitation(invitation, commit=False):
+                return make_err_response('邀请码已过期或已使用', error_code='INVITE_EXPIRED')
+
+            dao.add_baby_manager(
+                baby_id=invitation.baby_id,
+                user_id=user_id,
+                invited_by=invitation.inviter_id,
+                commit=False
+            )
+    except dao.TransactionFailed:
         return make_err_response('接受邀请失败', error_code='ACCEPT_INVITE_FAILED')
 
-    # 使用邀请
-    dao.use_invitation(invitation)
-
     # 获取宝宝信息
     baby = dao.get_baby_by_id(invitation.baby_id)
 
     return make_succ_response({
         'message': '已成为管理员',
-        'baby': baby.to_dict() if baby else None
+        'baby': baby
     })
 
 
@@ -506,17 +574,17 @@ def get_managers(baby_id):
     if not check_baby_permission(baby_id, user_id):
         return make_err_response('无权限访问', error_code='PERMISSION_DENIED')
 
-    managers = dao.get_baby_managers(baby_id)
-    result = []
-    for m in managers:
-        user = dao.get_user_by_id(m.user_id)
-        result.append({
-            'user_id': m.user_id,
-            'nickname': user.nickname if user else None,
-            'avatar_url': user.avatar_url if user else None,
-            'role': m.role,
-            'created_at': m.created_at.isoformat() if m.created_at else None
-        })
+    result = [
+        {
+            'user_id': manager_user_id,
+            'nickname': nickname,
+            'avatar_url': avatar_url,
+            'role': role,
+            'created_at': created_at
+        }
+        for manager_user_id, role, created_at, nickname, avatar_url
+        in dao.get_baby_managers_with_users(baby_id)
+    ]
 
     return make_succ_response({'managers': result})
 
@@ -526,20 +594,22 @@ def get_managers(baby_id):
 def remove_manager(baby_id, target_user_id):
     """移除管理员"""
     user_id = get_current_user_id()
+    manager = dao.get_baby_manager(baby_id, user_id)
 
     # 如果是自己退出
     if target_user_id == user_id:
-        manager = dao.get_baby_manager(baby_id, user_id)
         if manager and manager.role == 'owner':
             return make_err_response('创建者不能退出', error_code='PERMISSION_DENIED')
         dao.remove_baby_manager(baby_id, user_id)
+        invalidate_baby_permission(baby_id, user_id)
         return make_succ_response({'message': '已退出管理'})
 
     # 否则需要owner权限
-    if not check_baby_permission(baby_id, user_id, require_owner=True):
+    if not check_baby_permission(baby_id, user_id, require_owner=True, manager=manager):
         return make_err_response('仅创建者可移除他人', error_code='PERMISSION_DENIED')
 
     dao.remove_baby_manager(baby_id, target_user_id)
+    invalidate_baby_permission(baby_id, target_user_id)
     return make_succ_response({'message': '已移除管理员'})
 
 
@@ -563,32 +633,31 @@ def get_foods():
 
     foods = dao.get_all_foods(category=category, max_month=month)
 
+    # 如果指定了baby_id，一次查出该宝宝所有食材的状态
+    status_map = dao.get_baby_food_status_map(baby_id) if baby_id else None
+
     # 按分类分组
+    category_names = Food.CATEGORY_NAMES
     categories_map = {}
     for food in foods:
         cat = food.category
-        if cat not in categories_map:
-            categories_map[cat] = {
+        group = categories_map.get(cat)
+        if group is None:
+            group = categories_map[cat] = {
                 'category': cat,
-                'category_name': Food.CATEGORY_NAMES.get(cat, cat),
+                'category_name': category_names.get(cat, cat),
                 'foods': []
             }
 
         food_data = food.to_dict()
 
-        # 如果指定了baby_id，获取该宝宝的食材状态
-        if baby_id:
-            status = dao.get_baby_food_status(baby_id, food.id)
-            food_data['baby_status'] = status.status if status else 'unknown'
+        if status_map is not None:
+            food_data['baby_status'] = status_map.get(food.id, 'unknown')
 
-        categories_map[cat]['foods'].append(food_data)
+        group['foods'].append(food_data)
 
     # 按分类排序
-    category_order = ['staple', 'vegetable', 'fruit', 'meat', 'dairy', 'seafood']
-    result = []
-    for cat in category_order:
-        if cat in categories_map:
-            result.append(categories_map[cat])
+    result = [categories_map[cat] for cat in Food.CATEGORIES if cat in categories_map]
 
     return make_succ_response({'categories': result})
 
@@ -601,7 +670,7 @@ def get_food(food_id):
     if not food:
         return make_err_response('食材不存在', error_code='NOT_FOUND')
 
-    return make_succ_response(food.to_dict())
+    return make_succ_response(food)
 
 
 @app.route('/api/babies/<int:baby_id>/foods', methods=['GET'])
@@ -618,29 +687,33 @@ def get_baby_foods(baby_id):
         return make_err_response('无权限访问', error_code='PERMISSION_DENIED')
 
     status = request.args.get('status')
-    food_statuses = dao.get_baby_food_statuses(baby_id, status)
 
-    # 统计各状态数量
+    # 一次查询全部状态，筛选和统计都在内存中完成
     all_statuses = dao.get_baby_food_statuses(baby_id)
-    safe_count = sum(1 for s in all_statuses if s.status == 'safe')
-    allergic_count = sum(1 for s in all_statuses if s.status == 'allergic')
-    testing_count = sum(1 for s in all_statuses if s.status == 'testing')
+    if status:
+        food_statuses = [s for s in all_statuses if s.status == status]
+    else:
+        food_statuses = all_statuses
+
+    # 统计各状态数量（一次遍历）
+    status_counts = Counter(s.status for s in all_statuses)
+
+    food_by_id = {food.id: food for food in dao.get_foods_by_ids([fs.food_id for fs in food_statuses])}
 
     result = []
     for fs in food_statuses:
-        food = dao.get_food_by_id(fs.food_id)
+        food = food_by_id.get(fs.food_id)
         if food:
-            result.append({
-                **fs.to_dict(),
+            result.append(fs.to_dict(extra={
                 'food_name': food.name,
                 'category': food.category,
                 'category_name': Food.CATEGORY_NAMES.get(food.category, food.category)
-            })
+            }))
 
     return make_succ_response({
-        'safe_count': safe_count,
-        'allergic_count': allergic_count,
-        'testing_count': testing_count,
+        'safe_count': status_counts['safe'],
+        'allergic_count': status_counts['allergic'],
+        'testing_count': status_counts['testing'],
         'foods': result
     })
 
@@ -664,23 +737,12 @@ def batch_update_baby_food_status(baby_id):
     if not items:
         return make_succ_response({'message': '无需更新', 'updated_count': 0})
 
-    updated_count = 0
-    for item in items:
-        food_id = item.get('food_id')
-        status = item.get('status')
-
-        if not food_id or status not in ['safe', 'allergic', 'testing']:
-            continue
-
-        food_status = dao.create_or_update_baby_food_status(
-            baby_id=baby_id,
-            food_id=food_id,
-            status=status,
-            updated_by=user_id,
-            notes=item.get('notes')
-        )
-        if food_status:
-            updated_count += 1
+    # 跳过缺少食材ID或状态无效的条目，其余一条语句批量写入
+    valid_items = [
+        item for item in items
+        if item.get('food_id') and item.get('status') in _VALID_FOOD_STATUSES
+    ]
+    updated_count = dao.bulk_upsert_baby_food_statuses(baby_id, user_id, valid_items)
 
     return make_succ_response({
         'message': f'已更新 {updated_count} 个食材状态',
@@ -706,7 +768,7 @@ def update_baby_food_status(baby_id, food_id):
     params = request.get_json() or {}
     status = params.get('status')
 
-    if status not in ['safe', 'allergic', 'testing']:
+    if status not in _VALID_FOOD_STATUSES:
         return make_err_response('状态参数错误', error_code='INVALID_PARAMS')
 
     food_status = dao.create_or_update_baby_food_status(
@@ -722,7 +784,7 @@ def update_baby_food_status(baby_id, food_id):
         return make_err_response('更新失败', error_code='UPDATE_FAILED')
 
     return make_succ_response({
-        'food_status': food_status.to_dict(),
+        'food_status': food_status,
         'message': '更新成功'
     })
 
@@ -761,7 +823,7 @@ def start_food_test(baby_id, food_id):
     food = dao.get_food_by_id(food_id)
 
     return make_succ_response({
-        'food_status': food_status.to_dict(),
+        'food_status': food_status,
         'food_name': food.name if food else None,
         'message': f'开始排敏"{food.name if food else ""}"，观察期3天'
     })
@@ -771,6 +833,38 @@ def start_food_test(baby_id, food_id):
 # 辅食计划模块 API
 # ==========================================
 
+def _load_baby_age_months(baby_id: int) -> Optional[int]:
+    """宝宝月龄，宝宝不存在时返回 None"""
+    baby = dao.get_baby_by_id(baby_id)
+    return baby.get_age_months() if baby else None
+
+
+def _load_special_status_dict(baby_id: int) -> Optional[dict]:
+    """当前生效的特殊状态（字典），没有时返回 None"""
+    status = dao.get_active_special_status(baby_id)
+    return status.to_dict() if status else None
+
+
+def _load_testing_food_summary(baby_id: int) -> Optional[dict]:
+    """正在排敏的食材及剩余天数，没有时返回 None"""
+    testing_food = dao.get_baby_testing_food(baby_id)
+    if not testing_food:
+        return None
+    return {
+        'food_id': testing_food.food_id,
+        'days_remaining': testing_food.get_testing_days_remaining()
+    }
+
+
+def _load_plans_for_day(baby_id: int, plan_date: date) -> List[Tuple[dict, Optional[date]]]:
+    """当天的计划，每项为（计划字典, 新食材的排敏开始日期）"""
+    return [
+        (plan.to_dict(),
+         plan.new_food_status.testing_start_date if plan.new_food_status else None)
+        for plan in dao.get_meal_plans_by_date(baby_id, plan_date)
+    ]
+
+
 @app.route('/api/babies/<int:baby_id>/meal-plans', methods=['GET'])
 @login_required
 def get_meal_plans(baby_id):
@@ -784,82 +878,78 @@ def get_meal_plans(baby_id):
     if not check_baby_permission(baby_id, user_id):
         return make_err_response('无权限访问', error_code='PERMISSION_DENIED')
 
+    today = clock.today()
     date_str = request.args.get('date')
     if date_str:
         try:
-            plan_date = datetime.strptime(date_str, '%Y-%m-%d').date()
+            plan_date = date.fromisoformat(date_str)
         except ValueError:
             return make_err_response('日期格式错误', error_code='INVALID_PARAMS')
     else:
-        plan_date = date.today()
-
-    baby = dao.get_baby_by_id(baby_id)
-    if not baby:
+        plan_date = today
+
+    # 启用 Redis 时直接返回当前数据版本下缓存的响应体（特殊状态、排敏天数等随日期变化，键中带上今天）
+    cache_key = redis_client.baby_payload_key(baby_id, f'meal_plans:{plan_date.isoformat()}:{today.isoformat()}')
+    if cache_key:
+        body = redis_client.get_baby_payload(cache_key)
+        if body is not None:
+            return make_conditional_body_response(body)
+
+    # 宝宝、特殊状态、排敏中食材、当天计划四个查询相互独立，并行执行；
+    # 每个任务在自己的会话内把结果转成普通数据，不把 ORM 实例带出工作线程
+    age_months, special_status, testing_food, plans = concurrency.run_parallel(
+        lambda: _load_baby_age_months(baby_id),
+        lambda: _load_special_status_dict(baby_id),
+        lambda: _load_testing_food_summary(baby_id),
+        lambda: _load_plans_for_day(baby_id, plan_date)
+    )
+    if age_months is None:
         return make_err_response('宝宝不存在', error_code='NOT_FOUND')
 
-    # 获取特殊状态
-    special_status = dao.get_active_special_status(baby_id)
-
-    # 获取正在排敏的食材
-    testing_food = dao.get_baby_testing_food(baby_id)
-
     # 判断是否可以添加新食材
     can_add_new_food = not special_status and not testing_food
 
-    # 获取当天的计划
-    plans = dao.get_meal_plans_by_date(baby_id, plan_date)
+    # 所有计划涉及的食材（含新食材）去重后一次从食材缓存取出
+    wanted = {fid for plan_dict, _ in plans for fid in plan_dict['food_ids']}
+    wanted.update(plan_dict['new_food_id'] for plan_dict, _ in plans if plan_dict['new_food_id'])
+    food_by_id = {food.id: food for food in dao.get_foods_by_ids(list(wanted))}
 
     plans_data = []
-    for plan in plans:
-        food_ids = plan.get_food_id_list()
-        foods = dao.get_foods_by_ids(food_ids)
-        foods_data = []
-        for f in foods:
-            is_new = plan.new_food_id == f.id
-            foods_data.append({
-                'id': f.id,
-                'name': f.name,
-                'is_new': is_new
-            })
+    for plan_dict, testing_start_date in plans:
+        new_food_id = plan_dict['new_food_id']
+        foods_data = [
+            _PlanFood(f.id, f.name, f.id == new_food_id)
+            for f in map(food_by_id.get, dict.fromkeys(plan_dict['food_ids'])) if f
+        ]
 
         new_food_data = None
-        if plan.new_food_id:
-            new_food = dao.get_food_by_id(plan.new_food_id)
-            if new_food:
-                status = dao.get_baby_food_status(baby_id, new_food.id)
-                new_food_data = {
-                    'id': new_food.id,
-                    'name': new_food.name,
-                    'testing_day': (date.today() - status.testing_start_date).days + 1 if status and status.testing_start_date else 1
-                }
-
-        plans_data.append({
-            **plan.to_dict(),
-            'foods': foods_data,
-            'new_food': new_food_data
-        })
-
-    # 根据月龄计算应显示的餐次
-    age_months = baby.get_age_months()
-    if age_months <= 6:
-        meals_for_age = ['lunch']
-    elif age_months <= 8:
-        meals_for_age = ['lunch', 'dinner']
-    else:
-        meals_for_age = ['breakfast', 'lunch', 'dinner']
-
-    return make_succ_response({
-        'date': plan_date.isoformat(),
+        new_food = food_by_id.get(new_food_id) if new_food_id else None
+        if new_food:
+            new_food_data = _PlanNewFood(
+                new_food.id,
+                new_food.name,
+                (today - testing_start_date).days + 1 if testing_start_date else 1
+            )
+
+        plan_dict['foods'] = foods_data
+        plan_dict['new_food'] = new_food_data
+        plans_data.append(plan_dict)
+
+    # 根据月龄查表得到应显示的餐次
+    meals_for_age = _MEALS_BY_MONTH[min(max(age_months, 0), len(_MEALS_BY_MONTH) - 1)]
+
+    body = make_succ_body({
+        'date': plan_date,
         'baby_age_months': age_months,
         'meals_for_age': meals_for_age,  # 根据月龄应显示的餐次
-        'special_status': special_status.to_dict() if special_status else None,
+        'special_status': special_status,
         'can_add_new_food': can_add_new_food,
-        'testing_food': {
-            'food_id': testing_food.food_id,
-            'days_remaining': testing_food.get_testing_days_remaining()
-        } if testing_food else None,
+        'testing_food': testing_food,
         'plans': plans_data
     })
+    if cache_key:
+        redis_client.set_baby_payload(cache_key, body)
+    return make_conditional_body_response(body)
 
 
 @app.route('/api/babies/<int:baby_id>/meal-plans', methods=['POST'])
@@ -889,44 +979,59 @@ def create_meal_plan(baby_id):
         return make_err_response('缺少日期参数', error_code='INVALID_PARAMS')
     if not meal_type:
         return make_err_response('缺少餐次参数', error_code='INVALID_PARAMS')
+    if meal_type not in _VALID_MEAL_TYPES:
+        return make_err_response('餐次参数错误', error_code='INVALID_PARAMS')
     if not food_ids:
         return make_err_response('请选择食材', error_code='INVALID_PARAMS')
+    if not isinstance(food_ids, list):
+        return make_err_response('食材参数错误', error_code='INVALID_PARAMS')
+    food_ids = [_parse_food_id(fid) for fid in food_ids]
+    if None in food_ids:
+        return make_err_response('食材参数错误', error_code='INVALID_PARAMS')
+
+    new_food_id = params.get('new_food_id')
+    if new_food_id is not None:
+        new_food_id = _parse_food_id(new_food_id)
+        if new_food_id is None:
+            return make_err_response('新食材参数错误', error_code='INVALID_PARAMS')
 
     try:
-        plan_date = datetime.strptime(date_str, '%Y-%m-%d').date()
-    except ValueError:
+        plan_date = date.fromisoformat(date_str)
+    except (TypeError, ValueError):
         return make_err_response('日期格式错误', error_code='INVALID_PARAMS')
 
-    # 如果有新食材，检查是否可以添加
-    new_food_id = params.get('new_food_id')
+    # 如果有新食材，检查是否可以添加（只需判断特殊状态是否存在和排敏中食材ID，一条查询完成）
+    testing_food_id = None
     if new_food_id:
-        special_status = dao.get_active_special_status(baby_id)
-        if special_status:
+        has_special_status, testing_food_id = dao.get_new_food_blockers(baby_id)
+        if has_special_status:
             return make_err_response('宝宝处于特殊状态，暂不建议添加新食材', error_code='SPECIAL_STATUS_ACTIVE')
 
-        testing = dao.get_baby_testing_food(baby_id)
-        if testing and testing.food_id != new_food_id:
+        if testing_food_id is not None and testing_food_id != new_food_id:
             return make_err_response('已有正在排敏的食材', error_code='TESTING_IN_PROGRESS')
 
-        # 如果是新食材，开始排敏
-        if not testing:
-            dao.start_food_testing(baby_id, new_food_id, user_id, days=3)
-
-    plan = dao.create_or_update_meal_plan(
-        baby_id=baby_id,
-        plan_date=plan_date,
-        meal_type=meal_type,
-        food_ids=food_ids,
-        created_by=user_id,
-        new_food_id=new_food_id,
-        notes=params.get('notes')
-    )
-
-    if not plan:
+    # 开始排敏与保存计划同一事务提交，任一失败时整体回滚
+    try:
+        with dao.transaction():
+            # 如果是新食材，开始排敏
+            if new_food_id and testing_food_id is None:
+                dao.start_food_testing(baby_id, new_food_id, user_id, days=3, commit=False)
+
+            plan = dao.create_or_update_meal_plan(
+                baby_id=baby_id,
+                plan_date=plan_date,
+                meal_type=meal_type,
+                food_ids=food_ids,
+                created_by=user_id,
+                new_food_id=new_food_id,
+                notes=params.get('notes'),
+                commit=False
+            )
+    except dao.TransactionFailed:
         return make_err_response('保存失败', error_code='SAVE_FAILED')
 
     return make_succ_response({
-        'plan': plan.to_dict(),
+        'plan': plan,
         'message': '保存成功'
     })
 
@@ -940,7 +1045,7 @@ def complete_meal_plan(baby_id, plan_id):
     if not check_baby_permission(baby_id, user_id):
         return make_err_response('无权限操作', error_code='PERMISSION_DENIED')
 
-    if not dao.complete_meal_plan(plan_id):
+    if not dao.complete_meal_plan(baby_id, plan_id):
         return make_err_response('操作失败', error_code='COMPLETE_FAILED')
 
     return make_succ_response({'message': '已完成'})
@@ -955,7 +1060,7 @@ def delete_meal_plan(baby_id, plan_id):
     if not check_baby_permission(baby_id, user_id):
         return make_err_response('无权限操作', error_code='PERMISSION_DENIED')
 
-    if not dao.delete_meal_plan(plan_id):
+    if not dao.delete_meal_plan(baby_id, plan_id):
         return make_err_response('删除失败', error_code='DELETE_FAILED')
 
     return make_succ_response({'message': '删除成功'})
@@ -976,8 +1081,8 @@ def get_special_status(baby_id):
 
     status = dao.get_active_special_status(baby_id)
 
-    return make_succ_response({
-        'special_status': status.to_dict() if status else None
+    return make_conditional_succ_response({
+        'special_status': status
     })
 
 
@@ -999,22 +1104,26 @@ def create_special_status(baby_id):
     params = request.get_json() or {}
     status_type = params.get('status_type')
 
-    if status_type not in ['sick', 'vaccine', 'other']:
+    if status_type not in _VALID_STATUS_TYPES:
         return make_err_response('状态类型错误', error_code='INVALID_PARAMS')
 
+    duration_days = params.get('duration_days', 14)
+    if type(duration_days) is not int or not 0 < duration_days <= _MAX_STATUS_DAYS:
+        return make_err_response('持续天数错误', error_code='INVALID_PARAMS')
+
     status = dao.create_special_status(
         baby_id=baby_id,
         status_type=status_type,
         created_by=user_id,
         description=params.get('description'),
-        duration_days=params.get('duration_days', 14)
+        duration_days=duration_days
     )
 
     if not status:
         return make_err_response('创建失败', error_code='CREATE_FAILED')
 
     return make_succ_response({
-        'special_status': status.to_dict(),
+        'special_status': status,
         'message': '已记录特殊状态，2周内暂不添加新食材'
     })
 
@@ -1039,7 +1148,11 @@ def end_special_status(baby_id, status_id):
 # ==========================================
 
 from flask import Response, stream_with_context
-import json as json_module
+from wxcloudrun.utils import fastjson
+
+# 预先编码的 SSE 异常/结束消息
+AGENT_ERROR_EVENT = b'data: ' + fastjson.dumps({'type': 'error', 'content': '服务异常，请稍后重试'}) + b'\n\n'
+AGENT_DONE_EVENT = b'data: [DONE]\n\n'
 
 @app.route('/api/babies/<int:baby_id>/agent/chat', methods=['POST'])
 @login_required
@@ -1080,17 +1193,15 @@ def agent_chat(baby_id):
 
     def generate():
         try:
-            for chunk in agent.chat_stream(message, conversation_id):
-                data = json_module.dumps(chunk, ensure_ascii=False)
-                yield f"data: {data}\n\n"
+            # chat_stream 直接产出编码好的 SSE 字节
+            yield from agent.chat_stream(message, conversation_id)
         except Exception as e:
             logger.error(f"Agent chat error: {e}", exc_info=True)
-            error_data = json_module.dumps({'type': 'error', 'content': '服务异常，请稍后重试'}, ensure_ascii=False)
-            yield f"data: {error_data}\n\n"
+            yield AGENT_ERROR_EVENT
         finally:
-            yield "data: [DONE]\n\n"
+            yield AGENT_DONE_EVENT
 
-    return Response(
+    response = Response(
         stream_with_context(generate()),
         mimetype='text/event-stream',
         headers={
@@ -1099,6 +1210,8 @@ def agent_chat(baby_id):
             'X-Accel-Buffering': 'no'
         }
     )
+    response.direct_passthrough = True
+    return response
 
 
 @app.route('/api/babies/<int:baby_id>/agent/conversation/<conversation_id>', methods=['GET'])